@@ -1,32 +1,51 @@
 # bot.py
 # Single-file Pyrogram bot — QR gen/scan, URL shortener, admin controls, ChatBase chat, web status.
-# Uses MongoDB (db: quicklink_bot) if provided, else falls back to local JSON storage.
-import requests
+# Uses MongoDB (db: quicklink_bot) if provided, else falls back to local SQLite storage.
 import os
+import sys
 import io
+import codecs
+import csv
 import json
+import hashlib
+import heapq
+import multiprocessing
 import time
 import asyncio
 import tempfile
-import secrets
+import sqlite3
+import subprocess
+import threading
 import urllib.parse
 from datetime import datetime, timedelta
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import asynccontextmanager
 from functools import partial
-from typing import Dict, Any, List, Optional
+from typing import Dict, Any, List, Optional, Tuple
 import random
+import secrets
+import signal
+import re
+from collections import OrderedDict, deque
 
 from dotenv import load_dotenv
 load_dotenv("/etc/secrets/.env") # Load .env file if it exists
-from pyrogram import Client, filters
-from pyrogram.types import InlineKeyboardMarkup, InlineKeyboardButton, Message
+from pyrogram import Client, filters, StopPropagation
+from pyrogram.file_id import FileId
+from pyrogram.types import (
+    InlineKeyboardMarkup, InlineKeyboardButton, Message, InlineQuery, InlineQueryResultArticle,
+    InlineQueryResultCachedPhoto, InlineQueryResultPhoto, InputTextMessageContent
+)
 import qrcode
-import requests
-from PIL import Image
+import qrcode.image.svg
+from PIL import Image, ImageChops, ImageFilter, ImageOps
 from pyzbar.pyzbar import decode as zbar_decode
+import aiohttp
 from aiohttp import web
-from pymongo import MongoClient, ReturnDocument
-from pymongo.errors import ServerSelectionTimeoutError
-from pyrogram.errors import FloodWait
+from pymongo import MongoClient, ReturnDocument, UpdateOne
+from pymongo.errors import DuplicateKeyError, OperationFailure, ServerSelectionTimeoutError
+from pyrogram.errors import FloodWait, UserIsBlocked, InputUserDeactivated, UserDeactivated, UserDeactivatedBan
 
 # -------------------------
 # Load env
@@ -51,8 +70,16 @@ CHATBASE_BOT_ID = os.getenv("CHATBASE_BOT_ID")
 if not BOT_TOKEN or not OWNER_ID:
     raise RuntimeError("Set TG_BOT_TOKEN and OWNER_ID in .env")
 
+# Scale-out: WORKER_COUNT processes/instances share the bot token and the storage below.
+# Each worker only handles users with user_id % WORKER_COUNT == WORKER_INDEX. With
+# WORKER_COUNT > 1 and no WORKER_INDEX, `python bot.py` starts all workers locally.
+WORKER_COUNT = max(1, int(os.getenv("WORKER_COUNT", "1")))
+WORKER_INDEX = int(os.getenv("WORKER_INDEX") or "0")  # empty counts as unset
+IS_LAUNCHER = WORKER_COUNT > 1 and not os.getenv("WORKER_INDEX")
+WORKER_ID = f"w{WORKER_INDEX}-{os.getpid()}-{secrets.token_hex(3)}"  # leader lease holder
+
 # -------------------------
-# Storage: prefer MongoDB (db=quicklink_bot), fallback to local JSON in temp
+# Storage: prefer MongoDB (db=quicklink_bot), fallback to local SQLite (WAL) in temp
 # -------------------------
 DB = None
 mongo_ok = False
@@ -66,78 +93,190 @@ if MONGO_URI:
         print(f"Warning: Mongo not available: {e}")
         mongo_ok = False
 
+# Legacy whole-file JSON store; only read once to migrate into the SQLite store below.
 STORAGE_FILE = os.path.join(tempfile.gettempdir(), "quicklink_bot_storage.json")
+LOCAL_DB_FILE = os.getenv("LOCAL_DB_FILE", os.path.join(tempfile.gettempdir(), "quicklink_bot_storage.sqlite3"))
+
+SCAN_CACHE_TTL = int(os.getenv("SCAN_CACHE_TTL", str(30 * 86400)))  # persisted scan results, seconds
+
+DEFAULT_FEATURES = {"shorten": True, "qrgen": True, "qrscan": True, "broadcast": True, "chat": True}
+
+# All storage calls (pymongo round trips and local SQLite writes) are blocking, so they
+# run on a dedicated I/O pool instead of the asyncio loop that drives Pyrogram + aiohttp.
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "8"))
+DB_POOL = ThreadPoolExecutor(max_workers=DB_POOL_SIZE, thread_name_prefix="db")
+LOCAL_LOCK = threading.RLock()  # one shared SQLite connection across DB_POOL threads
+
+
+async def run_db(fn, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(DB_POOL, partial(fn, *args, **kwargs))
+
+
+LOCAL_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (id INTEGER PRIMARY KEY, added REAL, dead TEXT, dead_ts REAL);
+CREATE TABLE IF NOT EXISTS stats (key TEXT PRIMARY KEY, n INTEGER NOT NULL DEFAULT 0);
+CREATE TABLE IF NOT EXISTS urls (id INTEGER PRIMARY KEY AUTOINCREMENT, url TEXT, ts INTEGER);
+CREATE TABLE IF NOT EXISTS config (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS long_urls (long_url TEXT PRIMARY KEY, short_url TEXT NOT NULL, ts INTEGER);
+CREATE TABLE IF NOT EXISTS broadcasts (id TEXT PRIMARY KEY, status TEXT, doc TEXT);
+CREATE TABLE IF NOT EXISTS scan_cache (key TEXT PRIMARY KEY, results TEXT, source TEXT, ts REAL);
+"""
 
 
 def load_storage_local() -> Dict[str, Any]:
-    default = {
-        "users": [],
-        "stats": {"shorten": 0, "qrgen": 0, "qrscan": 0},
-        "last_urls": [],
-        "features": {"shorten": True, "qrgen": True, "qrscan": True, "broadcast": True},
-        "last_broadcast": None
-    }
+    # Legacy JSON format (pre-SQLite); returns {} when there is nothing to migrate
     try:
         if os.path.exists(STORAGE_FILE):
             with open(STORAGE_FILE, "r", encoding="utf-8") as f:
-                d = json.load(f)
-                for k in default:
-                    if k not in d:
-                        d[k] = default[k]
-                return d
+                return json.load(f)
     except Exception as e:
         print(f"Warning: Could not load local storage: {e}")
-    return default
+    return {}
 
 
-def save_storage_local(data: Dict[str, Any]):
+def migrate_storage_local(conn: sqlite3.Connection):
+    d = load_storage_local()
+    if not d:
+        return
+    with conn:
+        conn.executemany("INSERT OR IGNORE INTO users (id, added) VALUES (?, ?)", [(u, time.time()) for u in d.get("users", [])])
+        conn.executemany("INSERT OR REPLACE INTO stats (key, n) VALUES (?, ?)", list(d.get("stats", {}).items()))
+        conn.executemany("INSERT INTO urls (url, ts) VALUES (?, ?)", [(u.get("url"), u.get("ts")) for u in reversed(d.get("last_urls", []))])
+        conn.execute("INSERT OR REPLACE INTO config (key, value) VALUES ('features', ?)", (json.dumps({**DEFAULT_FEATURES, **d.get("features", {})}),))
+        conn.execute("INSERT OR REPLACE INTO config (key, value) VALUES ('last_broadcast', ?)", (json.dumps(d.get("last_broadcast")),))
+    os.replace(STORAGE_FILE, STORAGE_FILE + ".migrated")
+    print(f"Migrated local JSON storage into {LOCAL_DB_FILE}")
+
+
+def open_storage_local() -> sqlite3.Connection:
+    # WAL mode: every write is a small atomic transaction, cost independent of the user count
+    conn = sqlite3.connect(LOCAL_DB_FILE, check_same_thread=False, timeout=30)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.executescript(LOCAL_SCHEMA)
+    # Liveness columns were added after the first SQLite release
+    cols = {r[1] for r in conn.execute("PRAGMA table_info(users)")}
+    for col, typ in (("dead", "TEXT"), ("dead_ts", "REAL")):
+        if col not in cols:
+            conn.execute(f"ALTER TABLE users ADD COLUMN {col} {typ}")
+    conn.execute("CREATE INDEX IF NOT EXISTS users_dead_ts ON users (dead_ts)")
     try:
-        with open(STORAGE_FILE, "w", encoding="utf-8") as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
+        migrate_storage_local(conn)
     except Exception as e:
-        print(f"Warning: Could not save local storage: {e}")
+        print(f"Warning: Could not migrate local storage: {e}")
+    return conn
+
+
+LOCAL_DB = None if mongo_ok else open_storage_local()
 
 
-LOCAL = load_storage_local()
+def local_write(sql: str, params=()):
+    with LOCAL_LOCK, LOCAL_DB:
+        LOCAL_DB.execute(sql, params)
 
 
-def register_user_db(user_id: int):
+def local_read(sql: str, params=()) -> list:
+    with LOCAL_LOCK:
+        return LOCAL_DB.execute(sql, params).fetchall()
+
+
+def local_get_config(key: str, default: Any = None) -> Any:
+    rows = local_read("SELECT value FROM config WHERE key = ?", (key,))
+    return json.loads(rows[0][0]) if rows else default
+
+
+def local_set_config(key: str, value: Any):
+    local_write("INSERT OR REPLACE INTO config (key, value) VALUES (?, ?)", (key, json.dumps(value)))
+
+
+# --- Blocking implementations (only ever called through run_db) ---
+def _register_user_sync(user_id: int) -> bool:
+    # A user talking to the bot again is alive: clear any dead mark left by a broadcast
     if mongo_ok:
         try:
-            DB["users"].update_one({"_id": user_id}, {"$setOnInsert": {"_id": user_id, "added": time.time()}}, upsert=True)
+            DB["users"].update_one({"_id": user_id}, {"$setOnInsert": {"_id": user_id, "added": time.time()},
+                                                      "$unset": {"dead": "", "dead_ts": ""}}, upsert=True)
+            return True
         except Exception as e:
             print(f"DB Error (register_user_db): {e}")
-    else:
-        if user_id not in LOCAL["users"]:
-            LOCAL["users"].append(user_id)
-            save_storage_local(LOCAL)
+            return False
+    # Primary-key index: O(log n) lookup instead of a list scan
+    local_write("INSERT INTO users (id, added) VALUES (?, ?) ON CONFLICT(id) DO UPDATE SET dead = NULL, dead_ts = NULL "
+                "WHERE dead IS NOT NULL", (user_id, time.time()))
+    return True
 
 
-def inc_stat_db(key: str, n: int = 1):
+def _get_dead_since_sync(since: float) -> List[Tuple[int, float]]:
+    # Users marked dead at or after `since`, as (user_id, dead_ts)
     if mongo_ok:
         try:
-            DB["stats"].update_one({"_id": "global"}, {"$inc": {f"counts.{key}": n}}, upsert=True)
+            return [(d["_id"], d["dead_ts"]) for d in DB["users"].find({"dead_ts": {"$gte": since}}, {"dead_ts": 1})]
+        except Exception as e:
+            print(f"DB Error (get_dead_since_db): {e}")
+            return []
+    return local_read("SELECT id, dead_ts FROM users WHERE dead_ts >= ?", (since,))
+
+
+def _mark_users_dead_sync(dead: Dict[int, str]):
+    # dead: {user_id: reason}; one bulk write per broadcast batch
+    if not dead:
+        return
+    now = time.time()
+    if mongo_ok:
+        try:
+            DB["users"].bulk_write([UpdateOne({"_id": u}, {"$set": {"dead": reason, "dead_ts": now}}) for u, reason in dead.items()],
+                                   ordered=False)
+        except Exception as e:
+            print(f"DB Error (mark_users_dead_db): {e}")
+        return
+    with LOCAL_LOCK, LOCAL_DB:
+        LOCAL_DB.executemany("UPDATE users SET dead = ?, dead_ts = ? WHERE id = ?", [(reason, now, u) for u, reason in dead.items()])
+
+
+def _get_recent_users_sync(limit: int) -> List[int]:
+    if mongo_ok:
+        try:
+            return [d["_id"] for d in DB["users"].find({"dead": None}, {"_id": 1}).sort("added", -1).limit(limit)]
+        except Exception as e:
+            print(f"DB Error (get_recent_users_db): {e}")
+            return []
+    return [r[0] for r in local_read("SELECT id FROM users WHERE dead IS NULL ORDER BY added DESC LIMIT ?", (limit,))]
+
+
+def _inc_stats_sync(counts: Dict[str, int]) -> bool:
+    # One merged write for a whole batch of buffered increments
+    if mongo_ok:
+        try:
+            DB["stats"].update_one({"_id": "global"}, {"$inc": {f"counts.{k}": n for k, n in counts.items()}}, upsert=True)
+            return True
         except Exception as e:
             print(f"DB Error (inc_stat_db): {e}")
-    else:
-        LOCAL["stats"][key] = LOCAL["stats"].get(key, 0) + n
-        save_storage_local(LOCAL)
+            return False
+    with LOCAL_LOCK, LOCAL_DB:
+        LOCAL_DB.executemany(
+            "INSERT INTO stats (key, n) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET n = n + excluded.n",
+            list(counts.items())
+        )
+    return True
 
 
-def push_short_url_db(url: str):
+def _push_short_urls_sync(urls: List[str]):
     ts = int(time.time())
     if mongo_ok:
         try:
-            DB["urls"].insert_one({"url": url, "ts": ts})
+            DB["urls"].insert_many([{"url": url, "ts": ts} for url in urls], ordered=False)
         except Exception as e:
             print(f"DB Error (push_short_url_db): {e}")
     else:
-        LOCAL["last_urls"].insert(0, {"url": url, "ts": ts})
-        LOCAL["last_urls"] = LOCAL["last_urls"][:20]
-        save_storage_local(LOCAL)
+        with LOCAL_LOCK, LOCAL_DB:
+            LOCAL_DB.executemany("INSERT INTO urls (url, ts) VALUES (?, ?)", [(url, ts) for url in urls])
+            # Keep only the latest 20, same as the old JSON list
+            LOCAL_DB.execute("DELETE FROM urls WHERE id <= (SELECT MAX(id) FROM urls) - 20")
 
 
-def get_stats_db() -> Dict[str, Any]:
+def _get_stats_sync() -> Dict[str, Any]:
+    stats = {"shorten": 0, "qrgen": 0, "qrscan": 0}
     if mongo_ok:
         try:
             s = DB["stats"].find_one({"_id": "global"}) or {}
@@ -145,10 +284,12 @@ def get_stats_db() -> Dict[str, Any]:
             return {"shorten": counts.get("shorten", 0), "qrgen": counts.get("qrgen", 0), "qrscan": counts.get("qrscan", 0)}
         except Exception as e:
             print(f"DB Error (get_stats_db): {e}")
-    return LOCAL["stats"]
+            return stats
+    stats.update(dict(local_read("SELECT key, n FROM stats")))
+    return stats
 
 
-def get_last_urls_db(n: int = 5) -> List[Dict[str, Any]]:
+def _get_last_urls_sync(n: int = 5) -> List[Dict[str, Any]]:
     if mongo_ok:
         try:
             docs = DB["urls"].find().sort("ts", -1).limit(n)
@@ -159,106 +300,1192 @@ def get_last_urls_db(n: int = 5) -> List[Dict[str, Any]]:
             return [{"url": d.get("url"), "ts": d.get("ts")} for d in docs]
         except Exception as e:
             print(f"DB Error (get_last_urls_db): {e}")
+            return []
     # Same for local
-    return LOCAL["last_urls"][:n]
+    return [{"url": u, "ts": ts} for u, ts in local_read("SELECT url, ts FROM urls ORDER BY id DESC LIMIT ?", (n,))]
+
+
+def _get_user_batch_sync(after_id: Optional[int], limit: int) -> List[int]:
+    # Cursor over live users in _id order: broadcasts stream batches instead of loading everyone
+    if mongo_ok:
+        try:
+            query = {"dead": None} if after_id is None else {"_id": {"$gt": after_id}, "dead": None}
+            return [d["_id"] for d in DB["users"].find(query, {"_id": 1}).sort("_id", 1).limit(limit)]
+        except Exception as e:
+            print(f"DB Error (get_user_batch_db): {e}")
+            raise
+    if after_id is None:
+        return [r[0] for r in local_read("SELECT id FROM users WHERE dead IS NULL ORDER BY id LIMIT ?", (limit,))]
+    return [r[0] for r in local_read("SELECT id FROM users WHERE id > ? AND dead IS NULL ORDER BY id LIMIT ?", (after_id, limit))]
+
+
+def _count_users_sync() -> Tuple[int, int]:
+    # (live, dead); dead users are the minority and covered by a sparse index
+    if mongo_ok:
+        try:
+            dead = DB["users"].count_documents({"dead": {"$exists": True}})
+            return max(DB["users"].estimated_document_count() - dead, 0), dead
+        except Exception as e:
+            print(f"DB Error (count_users_db): {e}")
+            return 0, 0
+    return tuple(local_read("SELECT COUNT(*) - COUNT(dead), COUNT(dead) FROM users")[0])
+
+
+def _save_broadcast_sync(job: Dict[str, Any]):
+    job = {**job, "updated": time.time()}
+    if mongo_ok:
+        try:
+            DB["broadcasts"].replace_one({"_id": job["_id"]}, job, upsert=True)
+        except Exception as e:
+            print(f"DB Error (save_broadcast_db): {e}")
+    else:
+        local_write("INSERT OR REPLACE INTO broadcasts (id, status, doc) VALUES (?, ?, ?)", (job["_id"], job["status"], json.dumps(job)))
 
 
-def get_all_users_db() -> List[int]:
+def _get_active_broadcasts_sync() -> List[Dict[str, Any]]:
     if mongo_ok:
         try:
-            return [d["_id"] for d in DB["users"].find({}, {"_id": 1})]
+            return list(DB["broadcasts"].find({"status": {"$in": ["queued", "running"]}}).sort("created", 1))
         except Exception as e:
-            print(f"DB Error (get_all_users_db): {e}")
-    return LOCAL["users"][:]
+            print(f"DB Error (get_active_broadcasts_db): {e}")
+            return []
+    rows = local_read("SELECT doc FROM broadcasts WHERE status IN ('queued', 'running')")
+    return sorted((json.loads(r[0]) for r in rows), key=lambda j: j.get("created", 0))
 
 
-def set_feature_db(key: str, val: bool):
+def _request_broadcast_stop_sync(job_id: str):
+    # Separate config key so the running job's checkpoint writes cannot overwrite it
+    if mongo_ok:
+        try:
+            DB["config"].update_one({"_id": f"bc_stop:{job_id}"}, {"$set": {"ts": time.time()}}, upsert=True)
+        except Exception as e:
+            print(f"DB Error (request_broadcast_stop_db): {e}")
+    else:
+        local_set_config(f"bc_stop:{job_id}", time.time())
+
+
+def _broadcast_stop_requested_sync(job_id: str) -> bool:
+    if mongo_ok:
+        try:
+            return DB["config"].find_one({"_id": f"bc_stop:{job_id}"}, {"_id": 1}) is not None
+        except Exception as e:
+            print(f"DB Error (broadcast_stop_requested_db): {e}")
+            return False
+    return local_get_config(f"bc_stop:{job_id}") is not None
+
+
+def _get_limits_sync() -> Dict[str, Dict[str, int]]:
+    if mongo_ok:
+        try:
+            doc = DB["config"].find_one({"_id": "limits"}) or {}
+            doc.pop("_id", None)
+            return doc
+        except Exception as e:
+            print(f"DB Error (get_limits_db): {e}")
+            return {}
+    return local_get_config("limits", {})
+
+
+def _set_limit_sync(op: str, limit: Dict[str, int]):
+    if mongo_ok:
+        try:
+            DB["config"].update_one({"_id": "limits"}, {"$set": {op: limit}}, upsert=True)
+        except Exception as e:
+            print(f"DB Error (set_limit_db): {e}")
+    else:
+        with LOCAL_LOCK:
+            local_set_config("limits", {**local_get_config("limits", {}), op: limit})
+
+
+def _acquire_leader_sync(holder: str, lease: float) -> bool:
+    # Take or renew the leader lease; only succeeds if we hold it or it has expired
+    now = time.time()
+    if mongo_ok:
+        try:
+            DB["config"].update_one({"_id": "leader", "$or": [{"holder": holder}, {"expires": {"$lt": now}}]},
+                                    {"$set": {"holder": holder, "expires": now + lease}}, upsert=True)
+            return True
+        except DuplicateKeyError:
+            return False  # someone else holds a live lease
+        except Exception as e:
+            print(f"DB Error (acquire_leader_db): {e}")
+            return False
+    with LOCAL_LOCK, LOCAL_DB:
+        cur = LOCAL_DB.execute(
+            "INSERT INTO config (key, value) VALUES ('leader', ?) ON CONFLICT(key) DO UPDATE SET value = excluded.value "
+            "WHERE json_extract(value, '$.holder') = ? OR json_extract(value, '$.expires') < ?",
+            (json.dumps({"holder": holder, "expires": now + lease}), holder, now))
+        return cur.rowcount == 1
+
+
+def _set_feature_sync(key: str, val: bool):
     if mongo_ok:
         try:
             DB["config"].update_one({"_id": "features"}, {"$set": {key: val}}, upsert=True)
         except Exception as e:
             print(f"DB Error (set_feature_db): {e}")
     else:
-        LOCAL["features"][key] = val
-        save_storage_local(LOCAL)
+        with LOCAL_LOCK:
+            features = local_get_config("features", {})
+            features[key] = val
+            local_set_config("features", features)
 
 
-def get_features_db() -> Dict[str, bool]:
+def _get_features_sync() -> Dict[str, bool]:
+    # Match your /admin command list
+    default_features = dict(DEFAULT_FEATURES)
     if mongo_ok:
         try:
             doc = DB["config"].find_one({"_id": "features"}) or {}
-            # Match your /admin command list
-            default_features = {"shorten": True, "qrgen": True, "qrscan": True, "broadcast": True, "chat": True}
             # Merge defaults with DB
             doc.pop("_id", None)
             default_features.update(doc)
-            return default_features
         except Exception as e:
             print(f"DB Error (get_features_db): {e}")
-    # Update local default to include 'chat'
-    if "chat" not in LOCAL["features"]:
-        LOCAL["features"]["chat"] = True
-    return LOCAL["features"]
+        return default_features
+    default_features.update(local_get_config("features", {}))
+    return default_features
+
+
+def _set_last_broadcast_sync(ts: int):
+    if mongo_ok:
+        try:
+            DB["config"].update_one({"_id": "last_broadcast"}, {"$set": {"ts": ts}}, upsert=True)
+        except Exception as e:
+            print(f"DB Error (set_last_broadcast_db): {e}")
+    else:
+        local_set_config("last_broadcast", ts)
+
+
+def _get_chat_cache_gen_sync() -> Optional[float]:
+    if mongo_ok:
+        try:
+            return (DB["config"].find_one({"_id": "chat_cache_gen"}) or {}).get("ts", 0.0)
+        except Exception as e:
+            print(f"DB Error (get_chat_cache_gen_db): {e}")
+            return None
+    return local_get_config("chat_cache_gen", 0.0)
+
+
+def _set_chat_cache_gen_sync(ts: float):
+    if mongo_ok:
+        try:
+            DB["config"].update_one({"_id": "chat_cache_gen"}, {"$set": {"ts": ts}}, upsert=True)
+        except Exception as e:
+            print(f"DB Error (set_chat_cache_gen_db): {e}")
+    else:
+        local_set_config("chat_cache_gen", ts)
+
+
+def _init_storage_sync():
+    if mongo_ok:
+        try:
+            # Ensure all features from the keyboard are in the config
+            DB["config"].update_one(
+                {"_id":"features"}, 
+                {"$setOnInsert": DEFAULT_FEATURES}, 
+                upsert=True
+            )
+        except Exception:
+            pass
+        try:
+            DB["scan_cache"].create_index("created", expireAfterSeconds=SCAN_CACHE_TTL)
+        except Exception as e:
+            print(f"DB Error (scan_cache index): {e}")
+        try:
+            DB["users"].create_index("dead", sparse=True)
+            DB["users"].create_index("dead_ts", sparse=True)
+        except Exception as e:
+            print(f"DB Error (users dead index): {e}")
+    else:
+        # Local SQLite schema is created when the store is opened; just expire old scans
+        local_write("DELETE FROM scan_cache WHERE ts < ?", (time.time() - SCAN_CACHE_TTL,))
+
+
+def _get_short_url_sync(long_url: str) -> Optional[str]:
+    if mongo_ok:
+        try:
+            doc = DB["long_urls"].find_one({"_id": long_url}, {"short": 1})
+            return doc.get("short") if doc else None
+        except Exception as e:
+            print(f"DB Error (get_short_url_db): {e}")
+            return None
+    rows = local_read("SELECT short_url FROM long_urls WHERE long_url = ?", (long_url,))
+    return rows[0][0] if rows else None
+
+
+def _put_short_url_sync(long_url: str, short_url: str):
+    # First short link wins; later custom aliases don't replace the reusable one
+    ts = int(time.time())
+    if mongo_ok:
+        try:
+            DB["long_urls"].update_one({"_id": long_url}, {"$setOnInsert": {"short": short_url, "ts": ts}}, upsert=True)
+        except Exception as e:
+            print(f"DB Error (put_short_url_db): {e}")
+    else:
+        local_write("INSERT OR IGNORE INTO long_urls (long_url, short_url, ts) VALUES (?, ?, ?)", (long_url, short_url, ts))
+
+
+def _get_scan_result_sync(keys: List[str]) -> Optional[Dict[str, Any]]:
+    if mongo_ok:
+        try:
+            doc = DB["scan_cache"].find_one({"_id": {"$in": keys}})
+            return {"results": doc["results"], "source": doc.get("source", "local")} if doc else None
+        except Exception as e:
+            print(f"DB Error (get_scan_result_db): {e}")
+            return None
+    marks = ",".join("?" * len(keys))
+    rows = local_read(f"SELECT results, source FROM scan_cache WHERE key IN ({marks}) LIMIT 1", tuple(keys))
+    return {"results": json.loads(rows[0][0]), "source": rows[0][1]} if rows else None
+
+
+def _put_scan_result_sync(keys: List[str], results: List[str], source: str):
+    if mongo_ok:
+        try:
+            now = datetime.utcnow()
+            for key in keys:
+                DB["scan_cache"].update_one({"_id": key}, {"$set": {"results": results, "source": source, "created": now}}, upsert=True)
+        except Exception as e:
+            print(f"DB Error (put_scan_result_db): {e}")
+    else:
+        with LOCAL_LOCK, LOCAL_DB:
+            LOCAL_DB.executemany(
+                "INSERT OR REPLACE INTO scan_cache (key, results, source, ts) VALUES (?, ?, ?, ?)",
+                [(key, json.dumps(results), source, time.time()) for key in keys]
+            )
+
+
+# --- Async storage API used by the handlers ---
+# Known-user cache: a bounded LRU of user IDs already registered, so the upsert only
+# goes to the DB for users this process has not seen yet. The value is when the user was
+# last seen by this process (0 for entries warmed from the DB).
+KNOWN_USERS_MAX = int(os.getenv("KNOWN_USERS_MAX", "50000"))
+KNOWN_USERS: "OrderedDict[int, float]" = OrderedDict()
+KNOWN_USERS_STATS = {"hits": 0, "misses": 0}
+DEAD_SYNC_INTERVAL = 30
+
+
+def remember_user(user_id: int, seen: Optional[float] = None):
+    KNOWN_USERS[user_id] = time.time() if seen is None else seen
+    KNOWN_USERS.move_to_end(user_id)
+    while len(KNOWN_USERS) > KNOWN_USERS_MAX:
+        KNOWN_USERS.popitem(last=False)
+
+
+def forget_user(user_id: int):
+    KNOWN_USERS.pop(user_id, None)
+
+
+async def warm_known_users():
+    ids = await run_db(_get_recent_users_sync, KNOWN_USERS_MAX)
+    for user_id in reversed(ids):  # most recent ends up most-recently-used
+        remember_user(user_id, seen=0.0)
+    print(f"Known-user cache warmed with {len(KNOWN_USERS)} users.")
+
+
+def known_users_metrics() -> Dict[str, Any]:
+    hits, misses = KNOWN_USERS_STATS["hits"], KNOWN_USERS_STATS["misses"]
+    total = hits + misses
+    return {"size": len(KNOWN_USERS), "max": KNOWN_USERS_MAX, "hits": hits, "misses": misses,
+            "hit_rate": round(hits / total, 4) if total else 0.0}
+
+
+async def register_user_db(user_id: int):
+    if user_id in KNOWN_USERS:
+        KNOWN_USERS[user_id] = time.time()
+        KNOWN_USERS.move_to_end(user_id)
+        KNOWN_USERS_STATS["hits"] += 1
+        return
+    KNOWN_USERS_STATS["misses"] += 1
+    if await run_db(_register_user_sync, user_id):
+        remember_user(user_id)
+
+
+async def dead_sync_loop():
+    # With several workers the leader marks users dead, but the user's own worker holds
+    # them in KNOWN_USERS and would never send the clearing upsert. Pick up new dead marks
+    # for users we own: if they were seen after the mark, clear it now; otherwise drop
+    # them from the cache so their next message goes through register_user_db's upsert.
+    since = time.time()
+    while True:
+        await asyncio.sleep(DEAD_SYNC_INTERVAL)
+        try:
+            for user_id, dead_ts in await run_db(_get_dead_since_sync, since):
+                since = max(since, dead_ts)
+                seen = KNOWN_USERS.get(user_id)
+                if seen is None or not owns_user(user_id):
+                    continue
+                if seen > dead_ts:
+                    await run_db(_register_user_sync, user_id)
+                else:
+                    forget_user(user_id)
+        except Exception as e:
+            print(f"Error (dead_sync_loop): {e}")
+
+
+# Write-behind stat counters: increments are merged in memory and flushed as a single
+# $inc (or one local file write) every STAT_FLUSH_INTERVAL seconds or STAT_FLUSH_EVENTS events.
+STAT_FLUSH_INTERVAL = float(os.getenv("STAT_FLUSH_INTERVAL", "10"))
+STAT_FLUSH_EVENTS = int(os.getenv("STAT_FLUSH_EVENTS", "50"))
+STAT_BUFFER: Dict[str, int] = {}
+STAT_BUFFER_EVENTS = 0
+STAT_FLUSH_LOCK = asyncio.Lock()
+BG_TASKS: set = set()  # strong refs for fire-and-forget tasks
+
+
+def spawn_bg(coro):
+    task = asyncio.create_task(coro)
+    BG_TASKS.add(task)
+    task.add_done_callback(BG_TASKS.discard)
+    return task
+
+
+async def flush_stats_db():
+    global STAT_BUFFER, STAT_BUFFER_EVENTS
+    async with STAT_FLUSH_LOCK:
+        if not STAT_BUFFER:
+            return
+        pending, STAT_BUFFER, STAT_BUFFER_EVENTS = STAT_BUFFER, {}, 0
+        ok = await run_db(_inc_stats_sync, pending)
+        if not ok:
+            # Keep the increments for the next flush instead of dropping them
+            for k, n in pending.items():
+                STAT_BUFFER[k] = STAT_BUFFER.get(k, 0) + n
+
+
+async def stat_flush_loop():
+    while True:
+        await asyncio.sleep(STAT_FLUSH_INTERVAL)
+        try:
+            await flush_stats_db()
+        except Exception as e:
+            print(f"Error (stat_flush_loop): {e}")
+
+
+async def inc_stat_db(key: str, n: int = 1):
+    global STAT_BUFFER_EVENTS
+    STAT_BUFFER[key] = STAT_BUFFER.get(key, 0) + n
+    STAT_BUFFER_EVENTS += 1
+    if STAT_BUFFER_EVENTS >= STAT_FLUSH_EVENTS and not STAT_FLUSH_LOCK.locked():
+        spawn_bg(flush_stats_db())
+
+
+async def push_short_url_db(url: str):
+    await run_db(_push_short_urls_sync, [url])
+
+
+async def push_short_urls_db(urls: List[str]):
+    if urls:
+        await run_db(_push_short_urls_sync, urls)
+
+
+async def get_stats_db() -> Dict[str, Any]:
+    # Serialized with flushes so an in-flight batch is never missed or counted twice.
+    # Exact for a single process; with WORKER_COUNT > 1 the other workers' unflushed
+    # buffers (at most STAT_FLUSH_INTERVAL / STAT_FLUSH_EVENTS worth) are not included.
+    async with STAT_FLUSH_LOCK:
+        stats = dict(await run_db(_get_stats_sync))
+        # Persisted values + whatever is still sitting in the write-behind buffer
+        for k, n in STAT_BUFFER.items():
+            stats[k] = stats.get(k, 0) + n
+    return stats
+
+
+async def get_last_urls_db(n: int = 5) -> List[Dict[str, Any]]:
+    return await run_db(_get_last_urls_sync, n)
+
+
+async def get_user_batch_db(after_id: Optional[int], limit: int) -> List[int]:
+    return await run_db(_get_user_batch_sync, after_id, limit)
+
+
+async def count_users_db() -> Tuple[int, int]:
+    return await run_db(_count_users_sync)
+
+
+async def mark_users_dead_db(dead: Dict[int, str]):
+    for user_id in dead:
+        forget_user(user_id)
+    await run_db(_mark_users_dead_sync, dead)
+
+
+async def save_broadcast_db(job: Dict[str, Any]):
+    await run_db(_save_broadcast_sync, job)
+
+
+async def get_active_broadcasts_db() -> List[Dict[str, Any]]:
+    return await run_db(_get_active_broadcasts_sync)
+
+
+async def request_broadcast_stop_db(job_id: str):
+    await run_db(_request_broadcast_stop_sync, job_id)
+
+
+async def broadcast_stop_requested_db(job_id: str) -> bool:
+    return await run_db(_broadcast_stop_requested_sync, job_id)
+
+
+# Feature flags are read on every command, so they are served from a short TTL cache.
+# Local toggles invalidate it immediately; with FEATURE_WATCH=1 a Mongo change stream
+# invalidates it too, so several bot instances converge without polling.
+FEATURE_CACHE_TTL = float(os.getenv("FEATURE_CACHE_TTL", "30"))
+FEATURE_WATCH = os.getenv("FEATURE_WATCH", "0") == "1"
+FEATURE_CACHE: Dict[str, Any] = {"value": None, "expires": 0.0, "gen": 0}
+
+
+def invalidate_features_cache():
+    FEATURE_CACHE["value"] = None
+    FEATURE_CACHE["gen"] += 1  # a read already in flight must not re-populate stale data
+
+
+async def set_feature_db(key: str, val: bool):
+    await run_db(_set_feature_sync, key, val)
+    invalidate_features_cache()
+
+
+async def get_features_db() -> Dict[str, bool]:
+    if FEATURE_CACHE["value"] is not None and time.monotonic() < FEATURE_CACHE["expires"]:
+        return dict(FEATURE_CACHE["value"])
+    gen = FEATURE_CACHE["gen"]
+    value = await run_db(_get_features_sync)
+    if gen == FEATURE_CACHE["gen"]:
+        FEATURE_CACHE.update(value=value, expires=time.monotonic() + FEATURE_CACHE_TTL)
+    return dict(value)
+
+
+def _watch_features_sync(loop: asyncio.AbstractEventLoop):
+    # Runs on its own daemon thread; a change stream blocks for as long as it is open
+    while True:
+        try:
+            with DB["config"].watch([{"$match": {"documentKey._id": "features"}}]) as stream:
+                for _ in stream:
+                    loop.call_soon_threadsafe(invalidate_features_cache)
+        except OperationFailure as e:
+            # e.g. standalone server without replica set: change streams unsupported
+            print(f"Warning: feature watch unavailable, using TTL only: {e}")
+            return
+        except Exception as e:
+            print(f"Warning: feature watch interrupted: {e}")
+            time.sleep(30)
+
+
+def start_feature_watch():
+    if mongo_ok and FEATURE_WATCH:
+        loop = asyncio.get_running_loop()
+        threading.Thread(target=_watch_features_sync, args=(loop,), name="feature-watch", daemon=True).start()
+
+
+async def set_last_broadcast_db(ts: int):
+    await run_db(_set_last_broadcast_sync, ts)
+
+
+async def init_storage_db():
+    await run_db(_init_storage_sync)
 
 
 # -------------------------
-# Temp helpers
+# Shared HTTP client (QuickLink, Chatbase, api.qrserver.com)
 # -------------------------
-def temp_path_for(prefix: str, suffix: str = ".png"):
-    return os.path.join(tempfile.gettempdir(), f"{prefix}_{secrets.token_hex(8)}{suffix}")
+# One pooled aiohttp session for every upstream call: keep-alive connections, a
+# per-host connection cap and cached DNS, instead of a fresh TCP+TLS handshake and a
+# default-executor thread per request.
+HTTP_POOL_LIMIT = int(os.getenv("HTTP_POOL_LIMIT", "100"))
+HTTP_PER_HOST_LIMIT = int(os.getenv("HTTP_PER_HOST_LIMIT", "20"))
+HTTP_SESSION: Optional[aiohttp.ClientSession] = None
 
 
-async def schedule_delete(path: str, delay: int = 300):
-    await asyncio.sleep(delay)
-    try:
-        if os.path.exists(path):
-            os.remove(path)
-    except Exception as e:
-        print(f"Warning: Could not delete temp file {path}: {e}")
+def get_http() -> aiohttp.ClientSession:
+    global HTTP_SESSION
+    if HTTP_SESSION is None or HTTP_SESSION.closed:
+        connector = aiohttp.TCPConnector(
+            limit=HTTP_POOL_LIMIT, limit_per_host=HTTP_PER_HOST_LIMIT,
+            ttl_dns_cache=300, keepalive_timeout=60
+        )
+        HTTP_SESSION = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=30, connect=10))
+    return HTTP_SESSION
+
+
+async def close_http():
+    if HTTP_SESSION is not None and not HTTP_SESSION.closed:
+        await HTTP_SESSION.close()
+
+
+# -------------------------
+# Upstream resilience: circuit breaker, retry budget, hedged requests
+# -------------------------
+class UpstreamError(Exception):
+    # Retriable upstream failure (timeout, connection error, 5xx); counts against the breaker
+    pass
+
+
+class CircuitOpenError(UpstreamError):
+    pass
+
+
+class Upstream:
+    # One per external service. The breaker opens after `failure_threshold` consecutive
+    # failures and fails fast for `reset_after` seconds, then lets a single trial call
+    # through (half-open). Retries are jittered and limited by a budget that refills at
+    # `retry_ratio` tokens per call, so retries can't multiply load during an outage.
+    # With `hedge`, a second request is fired once the first is slower than the
+    # observed p95 and whichever answers first wins (idempotent upstreams only).
+    def __init__(self, name: str, timeout: float, failure_threshold: int = 5, reset_after: float = 30.0,
+                 max_retries: int = 1, retry_ratio: float = 0.1, hedge: bool = False):
+        self.name = name
+        self.timeout = timeout
+        self.failure_threshold = failure_threshold
+        self.reset_after = reset_after
+        self.max_retries = max_retries
+        self.retry_ratio = retry_ratio
+        self.hedge = hedge
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trial_inflight = False
+        self.retry_tokens = 10.0
+        self.latencies: deque = deque(maxlen=200)
+        self.counters = {"calls": 0, "ok": 0, "failed": 0, "rejected": 0, "retries": 0, "hedges": 0, "hedge_wins": 0}
+
+    def p95(self) -> Optional[float]:
+        if len(self.latencies) < 20:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[int(len(ordered) * 0.95) - 1]
+
+    def allow(self) -> bool:
+        if self.state == "open":
+            if time.monotonic() - self.opened_at < self.reset_after:
+                return False
+            self.state = "half_open"
+        if self.state == "half_open":
+            if self.trial_inflight:
+                return False
+            self.trial_inflight = True
+        return True
+
+    def record_success(self, latency: float):
+        self.latencies.append(latency)
+        self.failures = 0
+        self.state = "closed"
+        self.trial_inflight = False
+        self.counters["ok"] += 1
+
+    def record_failure(self):
+        self.failures += 1
+        self.counters["failed"] += 1
+        if self.state == "half_open" or self.failures >= self.failure_threshold:
+            if self.state != "open":
+                print(f"Warning: circuit for {self.name} opened after {self.failures} failures")
+            self.state = "open"
+            self.opened_at = time.monotonic()
+        self.trial_inflight = False
+
+    async def _attempt(self, fn):
+        t0 = time.monotonic()
+        threshold = self.p95() if self.hedge else None
+        try:
+            if threshold is None:
+                result = await fn()
+            else:
+                result = await self._hedged(fn, threshold)
+        except asyncio.CancelledError:
+            self.trial_inflight = False
+            raise
+        except UpstreamError:
+            self.record_failure()
+            raise
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            self.record_failure()
+            raise UpstreamError(f"{self.name}: {e!r}") from e
+        except Exception as e:
+            # Anything else (e.g. a 200 with an HTML body failing JSON decoding) is still a
+            # failed call; it must reset trial_inflight or a half-open breaker never closes
+            self.record_failure()
+            raise UpstreamError(f"{self.name}: {e!r}") from e
+        self.record_success(time.monotonic() - t0)
+        return result
+
+    async def _hedged(self, fn, threshold: float):
+        first = asyncio.ensure_future(fn())
+        done, _ = await asyncio.wait({first}, timeout=threshold)
+        if done:
+            return first.result()
+        self.counters["hedges"] += 1
+        second = asyncio.ensure_future(fn())
+        pending = {first, second}
+        error = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for t in done:
+                    if t.exception() is None:
+                        if t is second:
+                            self.counters["hedge_wins"] += 1
+                        return t.result()
+                    error = t.exception()
+            raise error
+        finally:
+            for t in pending:
+                t.cancel()
+
+    async def call(self, fn):
+        # fn: zero-arg coroutine factory; called again for retries / hedges
+        self.counters["calls"] += 1
+        if not self.allow():
+            self.counters["rejected"] += 1
+            raise CircuitOpenError(f"{self.name} is temporarily unavailable")
+        self.retry_tokens = min(10.0, self.retry_tokens + self.retry_ratio)
+        attempt = 0
+        while True:
+            try:
+                return await self._attempt(fn)
+            except CircuitOpenError:
+                raise
+            except UpstreamError:
+                if attempt >= self.max_retries or self.retry_tokens < 1 or self.state == "open":
+                    raise
+                self.retry_tokens -= 1
+                attempt += 1
+                self.counters["retries"] += 1
+                await asyncio.sleep(random.uniform(0, 0.5 * 2 ** attempt))  # full jitter
+
+    def health(self) -> Dict[str, Any]:
+        p95 = self.p95()
+        return {"state": self.state, "consecutive_failures": self.failures,
+                "p95_ms": round(p95 * 1000) if p95 is not None else None,
+                "retry_tokens": round(self.retry_tokens, 1), **self.counters}
+
+
+UPSTREAMS: Dict[str, Upstream] = {
+    # Shortening isn't idempotent (random alias), so no hedging there
+    "quicklink": Upstream("quicklink", timeout=15, max_retries=1),
+    # Chatbase is slow and billed per call: no hedging, one retry at most
+    "chatbase": Upstream("chatbase", timeout=20, max_retries=1),
+    # Read-only decode API: safe to retry and hedge
+    "qrserver": Upstream("qrserver", timeout=20, max_retries=2, hedge=True),
+}
+
+
+def raise_for_upstream(r: aiohttp.ClientResponse, name: str):
+    if r.status >= 500 or r.status == 429:
+        raise UpstreamError(f"{name} returned HTTP {r.status}")
 
 
 # -------------------------
 # QR helpers
 # -------------------------
-def build_qr_png_bytes(data: str, size: int = 1000) -> bytes:
-    qr = qrcode.QRCode(version=None, error_correction=qrcode.constants.ERROR_CORRECT_H, box_size=10, border=4)
+# Output profiles: what gets encoded and uploaded for each QR type (see QR_TYPES).
+#   format: "png", "jpeg" or "svg" (SVG is sent as a document, Telegram photos can't be vector)
+#   mode:   PNG colour mode — "1" (1-bit), "P" (2-colour palette) or "RGB" (legacy)
+#   ec:     error-correction level L/M/Q/H; size: target pixels; zlib: PNG compress level 0-9
+# /qrbench (owner) reports bytes and encode time per profile for tuning.
+QR_PROFILES: Dict[str, Dict[str, Any]] = {
+    "mono":    {"format": "png", "mode": "1",   "ec": "M", "size": 800,  "zlib": 9},
+    "print":   {"format": "png", "mode": "1",   "ec": "H", "size": 1000, "zlib": 9},
+    "palette": {"format": "png", "mode": "P",   "ec": "M", "size": 800,  "zlib": 9},
+    "svg":     {"format": "svg", "mode": None,  "ec": "M", "size": 1000, "zlib": None},
+    "legacy":  {"format": "png", "mode": "RGB", "ec": "H", "size": 1000, "zlib": 6},
+    # Inline photo results are fetched by Telegram from our web server and must be JPEG
+    "inline":  {"format": "jpeg", "mode": "L",  "ec": "M", "size": 512,  "zlib": None},
+}
+# Profile for every /qrgen type except UPI (which always prints at EC level H)
+QR_DEFAULT_PROFILE = os.getenv("QR_DEFAULT_PROFILE", "mono")
+if QR_DEFAULT_PROFILE not in QR_PROFILES:
+    print(f"Warning: unknown QR_DEFAULT_PROFILE {QR_DEFAULT_PROFILE!r}, using 'mono'")
+    QR_DEFAULT_PROFILE = "mono"
+QR_EC_LEVELS = {
+    "L": qrcode.constants.ERROR_CORRECT_L, "M": qrcode.constants.ERROR_CORRECT_M,
+    "Q": qrcode.constants.ERROR_CORRECT_Q, "H": qrcode.constants.ERROR_CORRECT_H,
+}
+
+
+def get_qr_profile(name: str) -> Dict[str, Any]:
+    return QR_PROFILES.get(name) or QR_PROFILES[QR_DEFAULT_PROFILE]
+
+
+def build_qr_bytes(data: str, profile: Dict[str, Any]) -> bytes:
+    size = profile["size"]
+    qr = qrcode.QRCode(version=None, error_correction=QR_EC_LEVELS[profile["ec"]], box_size=1, border=4)
     qr.add_data(data)
     qr.make(fit=True)
-    img = qr.make_image(fill_color="black", back_color="white").convert("RGB")
-    img = img.resize((size, size), Image.LANCZOS)
+    # Pick the box size from the module count so the grid is drawn at (almost) the
+    # target size directly, then centre it on a white canvas: no resample pass.
+    modules = qr.modules_count + 2 * qr.border
+    qr.box_size = max(1, size // modules)
+    if profile["format"] == "svg":
+        return qr.make_image(image_factory=qrcode.image.svg.SvgPathImage).to_string(encoding="unicode").encode("utf-8")
+    grid = qr.make_image(fill_color="black", back_color="white").get_image()
+    side = max(size, grid.size[0])
+    img = Image.new("1", (side, side), 1)
+    offset = (side - grid.size[0]) // 2
+    img.paste(grid, (offset, offset))
+    if profile["mode"] == "P":
+        # 2-entry palette (index 0 black, 1 white); skips the slow quantizer
+        pal = Image.frombytes("P", img.size, img.convert("L").point(lambda v: 1 if v else 0).tobytes())
+        pal.putpalette([0, 0, 0, 255, 255, 255])
+        img = pal
+    elif profile["mode"] == "RGB":
+        img = img.convert("RGB")
     bio = io.BytesIO()
-    img.save(bio, format="PNG", optimize=True)
-    bio.seek(0)
-    return bio.read()
+    if profile["format"] == "jpeg":
+        img.convert("L").save(bio, format="JPEG", quality=90)
+    else:
+        img.save(bio, format="PNG", compress_level=profile["zlib"])
+    return bio.getvalue()
+
+
+def build_qr_png_bytes(data: str, size: int = 1000) -> bytes:
+    return build_qr_bytes(data, {**QR_PROFILES["legacy"], "size": size})
+
+
+# CPU job queue: renders and decodes are not handed to their pools directly but go
+# through a bounded priority queue. Interactive single requests outrank bulk work (benches,
+# warmups, future batch jobs), waiting users are told their position, and once the queue
+# is deep enough new jobs are shed (bulk first, at half the depth) instead of slowing
+# everyone down. Depth and wait times are exported in /metrics.
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 1
+CPU_QUEUE_MAX = int(os.getenv("CPU_QUEUE_MAX", "200"))
+CPU_QUEUE_NOTIFY_INTERVAL = 3.0  # seconds between queue-position updates
+
+
+class CpuQueueFull(Exception):
+    pass
+
+
+class CpuQueue:
+    def __init__(self, name: str, get_pool, workers: int, max_depth: int):
+        self.name = name
+        self.get_pool = get_pool
+        self.workers = workers
+        self.max_depth = max_depth
+        self.heap: List[Tuple[int, int, asyncio.Future]] = []
+        self.seq = 0
+        self.running = 0
+        self.waits: deque = deque(maxlen=500)  # seconds spent queued, recent jobs
+        self.counters = {"submitted": 0, "queued": 0, "shed": 0, "completed": 0}
+
+    def shed_depth(self, priority: int) -> int:
+        return self.max_depth if priority == PRIORITY_INTERACTIVE else self.max_depth // 2
+
+    def position(self, entry: Tuple[int, int, asyncio.Future]) -> int:
+        return 1 + sum(1 for e in self.heap if e[:2] < entry[:2])
+
+    async def submit(self, fn, *args, priority: int = PRIORITY_INTERACTIVE, on_queue=None):
+        self.counters["submitted"] += 1
+        if len(self.heap) >= self.shed_depth(priority):
+            self.counters["shed"] += 1
+            raise CpuQueueFull(f"{self.name} queue is full")
+        t0 = time.monotonic()
+        if self.running < self.workers and not self.heap:
+            self.running += 1
+        else:
+            await self._wait_turn(priority, on_queue)
+        self.waits.append(time.monotonic() - t0)
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.get_pool(), fn, *args)
+        finally:
+            self.counters["completed"] += 1
+            self._release()
+
+    async def _wait_turn(self, priority: int, on_queue):
+        fut = asyncio.get_running_loop().create_future()  # resolved when a worker slot is handed over
+        entry = (priority, self.seq, fut)
+        self.seq += 1
+        heapq.heappush(self.heap, entry)
+        self.counters["queued"] += 1
+        last = None
+        try:
+            while not fut.done():
+                pos = self.position(entry)
+                if on_queue is not None and pos != last:
+                    last = pos
+                    try:
+                        await on_queue(pos)
+                    except Exception:
+                        pass  # position notices are best-effort
+                try:
+                    await asyncio.wait_for(asyncio.shield(fut), CPU_QUEUE_NOTIFY_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+        except asyncio.CancelledError:
+            if fut.done():
+                self._release()  # got the slot but will not use it
+            else:
+                self.heap.remove(entry)
+                heapq.heapify(self.heap)
+            raise
+
+    def _release(self):
+        while self.heap:
+            _, _, fut = heapq.heappop(self.heap)
+            if not fut.done():
+                fut.set_result(None)
+                return
+        self.running -= 1
+
+    def metrics(self) -> Dict[str, Any]:
+        waits = sorted(self.waits)
+        by_priority = {"interactive": 0, "bulk": 0}
+        for priority, _, _ in self.heap:
+            by_priority["interactive" if priority == PRIORITY_INTERACTIVE else "bulk"] += 1
+        return {
+            "depth": len(self.heap), "depth_by_priority": by_priority, "max_depth": self.max_depth,
+            "running": self.running, "workers": self.workers, **self.counters,
+            "wait_ms_avg": round(sum(waits) * 1000 / len(waits), 1) if waits else 0.0,
+            "wait_ms_p95": round(waits[int(len(waits) * 0.95)] * 1000, 1) if waits else 0.0,
+        }
+
+
+# QR rendering is pure CPU, so it runs in a bounded process pool instead of on the
+# event loop thread. "fork" is used explicitly: a spawned child would re-import this
+# module and redo its module-level setup (Mongo connection, SQLite file, Client). The
+# fork happens lazily on the first render, after DB_POOL and pymongo's monitor threads
+# exist; children only run build_qr_bytes and never touch those inherited handles.
+QR_WORKERS = int(os.getenv("QR_WORKERS", str(max(1, (os.cpu_count() or 2) - 1))))
+QR_POOL = None
+
+
+def get_qr_pool():
+    global QR_POOL
+    if QR_POOL is None:
+        try:
+            QR_POOL = ProcessPoolExecutor(max_workers=QR_WORKERS, mp_context=multiprocessing.get_context("fork"))
+        except ValueError:
+            # No fork on this platform (e.g. Windows): threads still keep the loop free
+            QR_POOL = ThreadPoolExecutor(max_workers=QR_WORKERS, thread_name_prefix="qr")
+    return QR_POOL
+
+
+def reset_qr_pool(broken):
+    global QR_POOL
+    if QR_POOL is broken:
+        QR_POOL = None
+        broken.shutdown(wait=False, cancel_futures=True)
+
 
+QR_QUEUE = CpuQueue("qr", get_qr_pool, QR_WORKERS, CPU_QUEUE_MAX)
 
-def local_scan_qr(file_path: str) -> List[str]:
+
+async def render_qr(data: str, profile: Dict[str, Any], priority: int = PRIORITY_INTERACTIVE, on_queue=None) -> bytes:
+    pool = get_qr_pool()
+    try:
+        return await QR_QUEUE.submit(build_qr_bytes, data, profile, priority=priority, on_queue=on_queue)
+    except BrokenProcessPool:
+        # A pool worker died (e.g. OOM-killed) and broke the whole pool: rebuild it, retry once
+        print("QR pool broken, restarting it")
+        reset_qr_pool(pool)
+        return await QR_QUEUE.submit(build_qr_bytes, data, profile, priority=priority, on_queue=on_queue)
+
+
+# Content-addressed QR cache: key = hash(payload, size, EC level, encoding). Holds the
+# encoded bytes and, once sent, the Telegram file_id so repeats go out with no render
+# and no upload. Concurrent identical requests share one in-flight render.
+QR_CACHE_MAX = int(os.getenv("QR_CACHE_MAX", "512"))
+QR_CACHE: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+QR_INFLIGHT: Dict[str, asyncio.Task] = {}
+QR_CACHE_STATS = {"png_hits": 0, "file_id_hits": 0, "renders": 0, "collapsed": 0}
+
+
+def qr_cache_key(data: str, profile: Dict[str, Any]) -> str:
+    spec = f"{profile['format']}|{profile['mode']}|{profile['ec']}|{profile['size']}|{profile['zlib']}"
+    return hashlib.sha256(f"{spec}|{data}".encode("utf-8")).hexdigest()
+
+
+def qr_cache_put(key: str, **fields):
+    entry = QR_CACHE.setdefault(key, {"png": None, "file_id": None})
+    entry.update(fields)
+    QR_CACHE.move_to_end(key)
+    while len(QR_CACHE) > QR_CACHE_MAX:
+        QR_CACHE.popitem(last=False)
+
+
+async def get_qr_bytes(data: str, profile_name: str = QR_DEFAULT_PROFILE, on_queue=None) -> bytes:
+    profile = get_qr_profile(profile_name)
+    key = qr_cache_key(data, profile)
+    entry = QR_CACHE.get(key)
+    if entry and entry.get("png"):
+        QR_CACHE.move_to_end(key)
+        QR_CACHE_STATS["png_hits"] += 1
+        return entry["png"]
+    task = QR_INFLIGHT.get(key)
+    if task:
+        QR_CACHE_STATS["collapsed"] += 1
+    else:
+        QR_CACHE_STATS["renders"] += 1
+        task = asyncio.ensure_future(render_qr(data, profile, on_queue=on_queue))
+        QR_INFLIGHT[key] = task
+
+        def _done(t: asyncio.Task):
+            QR_INFLIGHT.pop(key, None)
+            if not t.cancelled() and t.exception() is None:
+                qr_cache_put(key, png=t.result())
+        task.add_done_callback(_done)
+    # shield: one waiter being cancelled must not cancel the shared render
+    return await asyncio.shield(task)
+
+
+async def send_qr_photo(reply_to: Message, data: str, caption: str, profile_name: str = QR_DEFAULT_PROFILE) -> Optional[Message]:
+    # Returns the sent QR message, or None when the render was refused (the user got the busy notice)
+    profile = get_qr_profile(profile_name)
+    is_svg = profile["format"] == "svg"
+    send = reply_to.reply_document if is_svg else reply_to.reply_photo
+    key = qr_cache_key(data, profile)
+    entry = QR_CACHE.get(key)
+    if entry and entry.get("file_id"):
+        QR_CACHE.move_to_end(key)
+        QR_CACHE_STATS["file_id_hits"] += 1
+        try:
+            return await send(entry["file_id"], caption=caption)
+        except Exception as e:
+            print(f"Warning: cached QR file_id rejected, re-uploading: {e}")
+            entry["file_id"] = None
+    notice = None
+
+    async def on_queue(position: int):
+        nonlocal notice
+        text = f"⏳ QR renderer is busy: you're #{position} in the queue..."
+        notice = await (notice.edit_text(text) if notice else reply_to.reply_text(text))
+
+    async with op_slot("qrgen", reply_to.reply_text) as ok:
+        if not ok:
+            await reply_to.reply_text(ADMISSION_BUSY_TEXT)
+            return None
+        try:
+            media = io.BytesIO(await get_qr_bytes(data, profile_name, on_queue=on_queue))
+        except CpuQueueFull:
+            await reply_to.reply_text(ADMISSION_BUSY_TEXT)
+            return None
+        finally:
+            if notice:
+                try:
+                    await notice.delete()
+                except Exception:
+                    pass
+    media.name = f"qr.{profile['format']}"
+    sent = await send(media, caption=caption)
+    sent_media = sent and (sent.document if is_svg else sent.photo)
+    if sent_media:
+        qr_cache_put(key, file_id=sent_media.file_id)
+    return sent
+
+
+def bench_qr_profiles(data: str, rounds: int = 5) -> List[Dict[str, Any]]:
+    rows = []
+    for name, profile in QR_PROFILES.items():
+        t0 = time.perf_counter()
+        for _ in range(rounds):
+            out = build_qr_bytes(data, profile)
+        rows.append({"profile": name, "bytes": len(out), "ms": (time.perf_counter() - t0) * 1000 / rounds})
+    return rows
+
+
+# Scans decode straight from the downloaded bytes on their own pool, so zbar work
+# never competes with the default executor and the happy path never touches disk.
+DECODE_WORKERS = int(os.getenv("DECODE_WORKERS", "4"))
+DECODE_POOL = ThreadPoolExecutor(max_workers=DECODE_WORKERS, thread_name_prefix="decode")
+DECODE_QUEUE = CpuQueue("decode", lambda: DECODE_POOL, DECODE_WORKERS, CPU_QUEUE_MAX)
+
+
+# Local decode cascade: cheap passes first, stop on the first success, give up once
+# SCAN_BUDGET_MS is spent (checked before every zbar pass, not just between stages).
+# The filter/rotate stages run on the smallest reduce() level that is still at least
+# SCAN_WORK_SIDE px long, so a large document costs the same as a phone photo. Which
+# stage succeeded is counted in SCAN_STAGE_STATS so the order in SCAN_STAGES can be
+# tuned from /metrics.
+SCAN_BUDGET_MS = int(os.getenv("SCAN_BUDGET_MS", "1500"))
+SCAN_STAGES = os.getenv("SCAN_STAGES", "gray,down2,down4,autocontrast,adaptive,invert,up2,rotate").split(",")
+SCAN_WORK_SIDE = 1000
+SCAN_STAGE_STATS: Dict[str, int] = {}
+
+
+def _adaptive_threshold(gray: Image.Image) -> Image.Image:
+    # Pixel goes black when it is darker than its local mean by more than a margin;
+    # handles uneven lighting / glare where a global threshold fails.
+    radius = max(4, min(gray.size) // 40)
+    local_mean = gray.filter(ImageFilter.BoxBlur(radius))
+    return ImageChops.subtract(local_mean, gray).point(lambda v: 0 if v > 12 else 255)
+
+
+def _pyramid_level(gray: Image.Image, factor: int, pyramid: Dict[int, Image.Image]) -> Image.Image:
+    if factor not in pyramid:
+        pyramid[factor] = gray.reduce(factor)
+    return pyramid[factor]
+
+
+def _scan_work_image(gray: Image.Image, pyramid: Dict[int, Image.Image]) -> Image.Image:
+    for factor in (4, 2):
+        if max(gray.size) // factor >= SCAN_WORK_SIDE:
+            return _pyramid_level(gray, factor, pyramid)
+    return gray
+
+
+def _scan_stage_images(gray: Image.Image, stage: str, pyramid: Dict[int, Image.Image]):
+    # Generator: each image is only built once the previous one failed to decode
+    w, h = gray.size
+    if stage == "gray":
+        yield gray
+    elif stage == "down2":
+        if min(w, h) >= 400:
+            yield _pyramid_level(gray, 2, pyramid)
+    elif stage == "down4":
+        if min(w, h) >= 800:
+            yield _pyramid_level(gray, 4, pyramid)
+    elif stage == "up2":
+        if max(w, h) < 500:
+            yield gray.resize((w * 2, h * 2), Image.NEAREST)
+    elif stage in ("autocontrast", "adaptive", "invert", "rotate"):
+        work = _scan_work_image(gray, pyramid)
+        if stage == "autocontrast":
+            yield ImageOps.autocontrast(work, cutoff=2)
+        elif stage == "adaptive":
+            yield _adaptive_threshold(work)
+        elif stage == "invert":
+            yield ImageOps.invert(work)
+        else:
+            for angle in (45, 30, -30):
+                yield work.rotate(angle, expand=True, fillcolor=255)
+
+
+def local_scan_qr(image_bytes: bytes) -> Tuple[List[str], Optional[str]]:
+    # Returns (decoded texts, stage that decoded them); stage is None on failure
+    deadline = time.perf_counter() + SCAN_BUDGET_MS / 1000
     try:
-        img = Image.open(file_path).convert("RGB")
-        decoded = zbar_decode(img)
-        results = [d.data.decode("utf-8") for d in decoded if d and d.data]
-        return results
+        gray = Image.open(io.BytesIO(image_bytes)).convert("L")
+        pyramid: Dict[int, Image.Image] = {}
+        for stage in SCAN_STAGES:
+            for img in _scan_stage_images(gray, stage.strip(), pyramid):
+                if time.perf_counter() > deadline:
+                    return [], "budget"
+                decoded = zbar_decode(img)
+                results = [d.data.decode("utf-8") for d in decoded if d and d.data]
+                if results:
+                    return results, stage.strip()
+        return [], None
     except Exception as e:
         print(f"Error (local_scan_qr): {e}")
-        return []
+        return [], None
+
+
+# Scan result cache: the same posters / payment codes get forwarded over and over.
+# Keyed by Telegram's file_unique_id (hit = no download at all) and by a content hash
+# of the bytes; bounded LRU in memory, persisted in Mongo / SQLite behind it.
+SCAN_CACHE_MAX = int(os.getenv("SCAN_CACHE_MAX", "2048"))
+SCAN_CACHE: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+SCAN_CACHE_STATS = {"hits": 0, "misses": 0}
+
+
+def scan_cache_keys(file_unique_id: Optional[str] = None, image_bytes: Optional[bytes] = None) -> List[str]:
+    keys = []
+    if file_unique_id:
+        keys.append(f"fu:{file_unique_id}")
+    if image_bytes is not None:
+        keys.append(f"sha:{hashlib.sha256(image_bytes).hexdigest()}")
+    return keys
+
+
+def _scan_cache_remember(keys: List[str], entry: Dict[str, Any]):
+    for key in keys:
+        SCAN_CACHE[key] = entry
+        SCAN_CACHE.move_to_end(key)
+    while len(SCAN_CACHE) > SCAN_CACHE_MAX:
+        SCAN_CACHE.popitem(last=False)
+
+
+async def get_scan_result(keys: List[str]) -> Optional[Dict[str, Any]]:
+    for key in keys:
+        if key in SCAN_CACHE:
+            SCAN_CACHE.move_to_end(key)
+            SCAN_CACHE_STATS["hits"] += 1
+            return SCAN_CACHE[key]
+    entry = await run_db(_get_scan_result_sync, keys) if keys else None
+    if entry:
+        SCAN_CACHE_STATS["hits"] += 1
+        _scan_cache_remember(keys, entry)
+    else:
+        SCAN_CACHE_STATS["misses"] += 1
+    return entry
 
 
-def fallback_scan_qr_api(file_path: str) -> List[str]:
+async def put_scan_result(keys: List[str], results: List[str], source: str):
+    if not keys or not results:
+        return
+    _scan_cache_remember(keys, {"results": results, "source": source})
+    await run_db(_put_scan_result_sync, keys, results, source)
+
+
+# Photo download sizing: Telegram keeps several resolutions of every photo and zbar
+# usually decodes a mid-size one, so /qrscan walks them smallest-first, starting at the
+# first size whose long side reaches SCAN_MIN_SIDE. The 800/1280 px sizes arrive as
+# PhotoSizeProgressive, which Pyrogram leaves out of Photo.thumbs, so each size is
+# addressed by re-encoding the photo's file_id with its size letter. /scanplan (owner)
+# runs the plan against a real photo.
+SCAN_MIN_SIDE = int(os.getenv("SCAN_MIN_SIDE", "320"))
+PHOTO_SIZE_BOXES = (("m", 320), ("x", 800), ("y", 1280), ("w", 2560))  # (type, long side)
+SCAN_DOWNLOAD_STATS: Dict[str, Any] = {"scans": 0, "downloads": 0, "bytes": 0, "download_ms": 0.0,
+                                       "decoded_at": {"reduced": 0, "full": 0}}
+
+
+def scan_download_plan(got: Message) -> List[Tuple[str, Optional[str]]]:
+    # [(label, file_id)]; file_id None means the message's own full-size file
+    plan = []
+    if got.photo:
+        fid = FileId.decode(got.photo.file_id)
+        full_size = fid.thumbnail_size
+        w, h = got.photo.width, got.photo.height
+        for size, box in PHOTO_SIZE_BOXES:
+            if SCAN_MIN_SIDE <= box < max(w, h) and size != full_size:
+                scale = box / max(w, h)
+                fid.thumbnail_size = size
+                plan.append((f"{round(w * scale)}x{round(h * scale)}", fid.encode()))
+    plan.append(("full", None))
+    return plan
+
+
+async def download_scan_image(got: Message, file_id: Optional[str]) -> bytes:
+    t0 = time.perf_counter()
+    buf = await app.download_media(file_id, in_memory=True) if file_id else await got.download(in_memory=True)
+    data = buf.getvalue()
+    SCAN_DOWNLOAD_STATS["downloads"] += 1
+    SCAN_DOWNLOAD_STATS["bytes"] += len(data)
+    SCAN_DOWNLOAD_STATS["download_ms"] += (time.perf_counter() - t0) * 1000
+    return data
+
+
+def scan_download_metrics() -> Dict[str, Any]:
+    st = SCAN_DOWNLOAD_STATS
+    return {**st, "download_ms": round(st["download_ms"], 1),
+            "avg_bytes_per_scan": st["bytes"] // st["scans"] if st["scans"] else 0,
+            "avg_download_ms": round(st["download_ms"] / st["downloads"], 1) if st["downloads"] else 0.0}
+
+
+def record_scan_stage(stage: Optional[str]):
+    key = stage or "failed"
+    SCAN_STAGE_STATS[key] = SCAN_STAGE_STATS.get(key, 0) + 1
+
+
+async def fallback_scan_qr_api(image_bytes: bytes) -> List[str]:
     # Using the API you requested: goqr.me/api/
     # This is a different API than your code had, but matches your prompt.
+    upstream = UPSTREAMS["qrserver"]
+
+    async def _request():
+        form = aiohttp.FormData()
+        form.add_field("file", image_bytes, filename="qr.png", content_type="image/png")
+        # This API is simple and requires no auth
+        async with get_http().post("https://api.qrserver.com/v1/read-qr-code/", data=form, timeout=aiohttp.ClientTimeout(total=upstream.timeout)) as r:
+            raise_for_upstream(r, upstream.name)
+            return await r.json(content_type=None)
+
     try:
-        with open(file_path, "rb") as f:
-            files = {"file": ("qr.png", f, "image/png")}
-            # This API is simple and requires no auth
-            r = requests.post("https://api.qrserver.com/v1/read-qr-code/", files=files, timeout=30)
-            j = r.json()
-            texts = []
-            for item in j:
-                for symbol in item.get("symbol", []):
-                    data = symbol.get("data")
-                    if data and not symbol.get("error"):
-                        texts.append(data)
-            return texts
+        j = await upstream.call(_request)
+        texts = []
+        for item in j:
+            for symbol in item.get("symbol", []):
+                data = symbol.get("data")
+                if data and not symbol.get("error"):
+                    texts.append(data)
+        return texts
     except Exception as e:
         print(f"Error (fallback_scan_qr_api): {e}")
         return []
@@ -267,33 +1494,186 @@ def fallback_scan_qr_api(file_path: str) -> List[str]:
 # -------------------------
 # QuickLink shorten helper
 # -------------------------
-def quicklink_shorten(long_url: str, alias: str = "") -> Dict[str, Any]:
+async def quicklink_shorten(long_url: str, alias: str = "") -> Dict[str, Any]:
     # Using the endpoint from your .env.example
     params = {"api": QUICKLINK_API_KEY, "url": long_url, "alias": alias or ""}
+    upstream = UPSTREAMS["quicklink"]
+
+    async def _request():
+        async with get_http().get(QUICKLINK_ENDPOINT, params=params, timeout=aiohttp.ClientTimeout(total=upstream.timeout)) as r:
+            raise_for_upstream(r, upstream.name)
+            if r.status == 200:
+                return await r.json(content_type=None) # Expects {"status": "success", "shortenedUrl": "..."}
+            # 4xx (bad URL, alias taken...) is a valid answer, not an outage
+            text = await r.text()
+            print(f"Error: QuickLink API returned status {r.status}: {text}")
+            return {"status": "error", "message": text}
+
     try:
-        r = requests.get(QUICKLINK_ENDPOINT, params=params, timeout=15)
-        if r.status_code == 200:
-            return r.json() # Expects {"status": "success", "shortenedUrl": "..."}
-        print(f"Error: QuickLink API returned status {r.status_code}: {r.text}")
-        return {"status": "error", "message": r.text}
+        return await upstream.call(_request)
+    except CircuitOpenError:
+        return {"status": "error", "message": "The shortener service is temporarily unavailable. Please try again in a minute."}
     except Exception as e:
         print(f"Error (quicklink_shorten): {e}")
         return {"status": "error", "message": str(e)}
 
 
+# Long-URL index: long_url -> short_url persisted in Mongo / SQLite with an LRU in
+# front. A random-alias request for a URL we've already shortened is answered with no
+# network I/O, and concurrent requests for the same URL share one upstream call.
+LONG_URL_CACHE_MAX = int(os.getenv("LONG_URL_CACHE_MAX", "10000"))
+LONG_URL_CACHE: "OrderedDict[str, str]" = OrderedDict()
+LONG_URL_INFLIGHT: Dict[str, asyncio.Task] = {}
+LONG_URL_STATS = {"hits": 0, "db_hits": 0, "upstream": 0, "collapsed": 0}
+
+
+def remember_short_url(long_url: str, short_url: str):
+    LONG_URL_CACHE[long_url] = short_url
+    LONG_URL_CACHE.move_to_end(long_url)
+    while len(LONG_URL_CACHE) > LONG_URL_CACHE_MAX:
+        LONG_URL_CACHE.popitem(last=False)
+
+
+async def _shorten_and_index(long_url: str, alias: str) -> Dict[str, Any]:
+    if not alias:
+        short_url = await run_db(_get_short_url_sync, long_url)
+        if short_url:
+            LONG_URL_STATS["db_hits"] += 1
+            remember_short_url(long_url, short_url)
+            return {"status": "success", "shortenedUrl": short_url, "cached": True}
+    LONG_URL_STATS["upstream"] += 1
+    res = await quicklink_shorten(long_url, alias)
+    short_url = res.get("shortenedUrl") or res.get("shortUrl") or ""
+    if res.get("status") == "success" and short_url:
+        if not alias:
+            remember_short_url(long_url, short_url)
+        await run_db(_put_short_url_sync, long_url, short_url)
+    return res
+
+
+async def shorten_url(long_url: str, alias: str = "") -> Dict[str, Any]:
+    # Custom aliases always hit QuickLink (the user wants that exact alias)
+    if alias:
+        return await _shorten_and_index(long_url, alias)
+    short_url = LONG_URL_CACHE.get(long_url)
+    if short_url:
+        LONG_URL_CACHE.move_to_end(long_url)
+        LONG_URL_STATS["hits"] += 1
+        return {"status": "success", "shortenedUrl": short_url, "cached": True}
+    task = LONG_URL_INFLIGHT.get(long_url)
+    if task:
+        LONG_URL_STATS["collapsed"] += 1
+    else:
+        task = asyncio.ensure_future(_shorten_and_index(long_url, ""))
+        LONG_URL_INFLIGHT[long_url] = task
+        task.add_done_callback(lambda _t: LONG_URL_INFLIGHT.pop(long_url, None))
+    return await asyncio.shield(task)
+
+
 # -------------------------
 # Chatbase support (simple)
 # -------------------------
-def chatbase_query(user_text: str) -> str:
+CHAT_EDIT_INTERVAL = float(os.getenv("CHAT_EDIT_INTERVAL", "1.5"))  # seconds between streamed edits
+CHAT_MAX_CHARS = 4000  # Telegram caps messages at 4096 chars
+
+# Answer cache for near-duplicate support questions, keyed on a normalized form of the
+# question (case/whitespace folded, punctuation stripped). Only real answers are
+# cached; errors and empty replies are not. The owner can flush it from /admin: the
+# flush stamps the shared "chat_cache_gen" config key, and every worker drops its own
+# cache when it sees the stamp change (checked at most every CHAT_CACHE_GEN_TTL).
+CHAT_CACHE_TTL = int(os.getenv("CHAT_CACHE_TTL", "3600"))
+CHAT_CACHE_MAX = int(os.getenv("CHAT_CACHE_MAX", "1000"))
+CHAT_CACHE: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+CHAT_CACHE_STATS = {"hits": 0, "misses": 0, "flushes": 0}
+CHAT_CACHE_GEN_TTL = 10
+CHAT_CACHE_GEN: Dict[str, Any] = {"value": None, "checked": 0.0}
+
+
+def normalize_question(text: str) -> str:
+    text = re.sub(r"['’]", "", text.casefold())  # "what's" == "whats"
+    text = re.sub(r"[^\w\s]", " ", text)  # "url-shortener" == "url shortener"
+    return " ".join(text.split())
+
+
+def chat_cache_get(user_text: str) -> Optional[str]:
+    key = normalize_question(user_text)
+    hit = CHAT_CACHE.get(key)
+    if hit and hit[0] > time.monotonic():
+        CHAT_CACHE.move_to_end(key)
+        CHAT_CACHE_STATS["hits"] += 1
+        return hit[1]
+    if hit:
+        CHAT_CACHE.pop(key, None)  # expired
+    CHAT_CACHE_STATS["misses"] += 1
+    return None
+
+
+def chat_cache_put(user_text: str, answer: str):
+    key = normalize_question(user_text)
+    if not key:
+        return
+    CHAT_CACHE[key] = (time.monotonic() + CHAT_CACHE_TTL, answer)
+    CHAT_CACHE.move_to_end(key)
+    while len(CHAT_CACHE) > CHAT_CACHE_MAX:
+        CHAT_CACHE.popitem(last=False)
+
+
+def chat_cache_flush() -> int:
+    n = len(CHAT_CACHE)
+    CHAT_CACHE.clear()
+    CHAT_CACHE_STATS["flushes"] += 1
+    return n
+
+
+async def chat_cache_check_gen():
+    if time.monotonic() - CHAT_CACHE_GEN["checked"] < CHAT_CACHE_GEN_TTL:
+        return
+    CHAT_CACHE_GEN["checked"] = time.monotonic()
+    gen = await run_db(_get_chat_cache_gen_sync)
+    if gen is not None and gen != CHAT_CACHE_GEN["value"]:
+        if CHAT_CACHE_GEN["value"] is not None:
+            chat_cache_flush()  # flushed from another worker
+        CHAT_CACHE_GEN["value"] = gen
+
+
+async def chat_cache_flush_all() -> int:
+    gen = time.time()
+    await run_db(_set_chat_cache_gen_sync, gen)
+    CHAT_CACHE_GEN["value"] = gen
+    return chat_cache_flush()
+
+
+async def chatbase_query(user_text: str, on_partial=None) -> str:
+    # on_partial: optional `async def (text_so_far)`; when given, Chatbase's streaming
+    # mode is used and it is awaited as chunks arrive (the caller throttles edits).
     if not CHATBASE_API_KEY or not CHATBASE_BOT_ID:
         return "Chatbase AI support is not configured by the admin."
+    await chat_cache_check_gen()
+    cached = chat_cache_get(user_text)
+    if cached:
+        return cached
     
     # Payload matches your feature list
-    payload = {"messages": [{"content": user_text, "role": "user"}], "chatbotId": CHATBASE_BOT_ID}
+    payload = {"messages": [{"content": user_text, "role": "user"}], "chatbotId": CHATBASE_BOT_ID, "stream": on_partial is not None}
     headers = {"Authorization": f"Bearer {CHATBASE_API_KEY}", "Content-Type": "application/json"}
+    upstream = UPSTREAMS["chatbase"]
+    # Streaming: the timeout applies between chunks, not to the whole answer
+    timeout = aiohttp.ClientTimeout(total=None, sock_read=upstream.timeout) if on_partial else aiohttp.ClientTimeout(total=upstream.timeout)
+
+    async def _request():
+        async with get_http().post("https://www.chatbase.co/api/v1/chat", headers=headers, json=payload, timeout=timeout) as r:
+            raise_for_upstream(r, upstream.name)
+            if not on_partial or r.content_type == "application/json":
+                return await r.json(content_type=None)
+            decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+            text = ""
+            async for chunk in r.content.iter_any():
+                text += decoder.decode(chunk)
+                await on_partial(text)
+            return {"text": text + decoder.decode(b"", final=True)}
+
     try:
-        r = requests.post("https://www.chatbase.co/api/v1/chat", headers=headers, json=payload, timeout=20)
-        jr = r.json()
+        jr = await upstream.call(_request)
         
         # Extract the text response
         text = jr.get("text") # This is the common response key
@@ -302,7 +1682,12 @@ def chatbase_query(user_text: str) -> str:
             if "messages" in jr and isinstance(jr["messages"], list) and jr["messages"]:
                 text = jr["messages"][-1].get("content","")
         
-        return text or "The AI returned an empty response."
+        if not text:
+            return "The AI returned an empty response."
+        chat_cache_put(user_text, text)
+        return text
+    except CircuitOpenError:
+        return "The AI support service is temporarily unavailable. Please try again in a minute."
     except Exception as e:
         print(f"Error (chatbase_query): {e}")
         return f"Chatbase AI error: {e}"
@@ -313,11 +1698,12 @@ def chatbase_query(user_text: str) -> str:
 # --- MODIFIED: Smart Client Initialization ---
 # -------------------------
 
-# Initialize Pyrogram Client
+# Initialize Pyrogram Client (one session file per worker)
+SESSION_NAME = "quicklink_bot" if WORKER_COUNT == 1 else f"quicklink_bot_w{WORKER_INDEX}"
 if API_ID_STR and API_HASH:
     print("Initializing Pyrogram with API_ID and API_HASH.")
     app = Client(
-        "quicklink_bot",
+        SESSION_NAME,
         bot_token=BOT_TOKEN,
         api_id=int(API_ID_STR),
         api_hash=API_HASH
@@ -325,13 +1711,343 @@ if API_ID_STR and API_HASH:
 else:
     print("Initializing Pyrogram with bot_token only (API_ID/API_HASH not found).")
     app = Client(
-        "quicklink_bot",
+        SESSION_NAME,
         bot_token=BOT_TOKEN
     )
 # --- End Modification ---
 
 
-INTERACTIVE: Dict[int, Dict[str, Any]] = {}
+# Update routing: every worker's session receives every update; a group -1 handler drops
+# the ones owned by another worker before any real handler (or listener) sees them. A
+# user always lands on the same worker, so their interactive session stays process-local.
+def owns_user(user_id: int) -> bool:
+    return user_id % WORKER_COUNT == WORKER_INDEX
+
+
+@app.on_message(group=-1)
+async def route_message(_, msg: Message):
+    if WORKER_COUNT > 1 and not owns_user(msg.from_user.id if msg.from_user else 0):
+        raise StopPropagation
+
+
+@app.on_callback_query(group=-1)
+async def route_callback(_, cq):
+    if WORKER_COUNT > 1 and not owns_user(cq.from_user.id):
+        raise StopPropagation
+
+
+@app.on_inline_query(group=-1)
+async def route_inline(_, iq):
+    # Inline QR images are served by the web server, which only runs on worker 0
+    if WORKER_COUNT > 1 and WORKER_INDEX != 0:
+        raise StopPropagation
+
+
+# -------------------------
+# Admission control
+# -------------------------
+# Every expensive operation has a per-user token bucket (checked when the user starts it,
+# owner exempt) and a global concurrency gate around the actual work. Requests over the
+# user's rate get an immediate "slow down"; requests over the global cap wait in a short
+# FIFO queue with a notice, and are turned away once that queue is full.
+# Limits live in the "limits" config doc and are changed with /admin limit.
+DEFAULT_LIMITS = {
+    "qrgen": {"per_min": 20, "burst": 5, "concurrency": 8},
+    "qrscan": {"per_min": 10, "burst": 3, "concurrency": 4},
+    "chat": {"per_min": 6, "burst": 2, "concurrency": 4},
+    "shorten": {"per_min": 20, "burst": 5, "concurrency": 8},
+    "bulkshort": {"per_min": 2, "burst": 1, "concurrency": 2},
+}
+LIMITS_TTL = 60  # seconds between reloads, so /admin changes reach every worker
+ADMISSION_QUEUE_FACTOR = int(os.getenv("ADMISSION_QUEUE_FACTOR", "4"))  # queue length = concurrency * factor
+ADMISSION_BUCKETS_MAX = 50000
+ADMISSION_BUSY_TEXT = "🚦 The bot is very busy right now. Please try again in a minute."
+LIMITS: Dict[str, Dict[str, int]] = {op: dict(v) for op, v in DEFAULT_LIMITS.items()}
+LIMITS_LOADED = 0.0
+USER_BUCKETS: "OrderedDict[Tuple[int, str], TokenBucket]" = OrderedDict()
+ADMISSION_STATS = {op: {"admitted": 0, "rate_limited": 0, "queued": 0, "shed": 0} for op in DEFAULT_LIMITS}
+
+
+class TokenBucket:
+    # rate tokens/s up to burst. Used for the broadcast send rate (where a FloodWait
+    # pauses the bucket for all senders) and for per-user admission control.
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def pause(self, seconds: float):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+    def try_acquire(self) -> bool:
+        now = time.monotonic()
+        if now < self.paused_until:
+            return False
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    async def acquire(self):
+        while not self.try_acquire():
+            now = time.monotonic()
+            if now < self.paused_until:
+                await asyncio.sleep(self.paused_until - now)
+            else:
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class OpGate:
+    # Global concurrency cap with a bounded FIFO wait queue
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.active = 0
+        self.waiters: deque = deque()
+
+    def queue_max(self) -> int:
+        return self.limit * ADMISSION_QUEUE_FACTOR
+
+    async def acquire(self, on_queue=None) -> bool:
+        if self.active < self.limit and not self.waiters:
+            self.active += 1
+            return True
+        if len(self.waiters) >= self.queue_max():
+            return False
+        fut = asyncio.get_running_loop().create_future()
+        self.waiters.append(fut)
+        try:
+            # Inside the try: a cancel during the notice must still withdraw the waiter
+            if on_queue is not None:
+                await on_queue(len(self.waiters))
+            await fut  # resolved by release() handing its slot over
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                self.release()
+            else:
+                self.waiters.remove(fut)
+            raise
+        return True
+
+    def release(self):
+        while self.waiters and self.active <= self.limit:
+            fut = self.waiters.popleft()
+            if not fut.done():
+                fut.set_result(None)
+                return
+        self.active -= 1
+
+    def set_limit(self, limit: int):
+        self.limit = limit
+        while self.waiters and self.active < self.limit:
+            fut = self.waiters.popleft()
+            if not fut.done():
+                self.active += 1
+                fut.set_result(None)
+
+
+OP_GATES = {op: OpGate(v["concurrency"]) for op, v in LIMITS.items()}
+
+
+def apply_limits(stored: Dict[str, Dict[str, int]]):
+    for op, default in DEFAULT_LIMITS.items():
+        new = {**default, **stored.get(op, {})}
+        if new != LIMITS[op]:
+            LIMITS[op] = new
+            OP_GATES[op].set_limit(new["concurrency"])
+            for key in [k for k in USER_BUCKETS if k[1] == op]:
+                del USER_BUCKETS[key]  # rebuilt with the new rate on next use
+
+
+async def get_limits() -> Dict[str, Dict[str, int]]:
+    global LIMITS_LOADED
+    if time.monotonic() - LIMITS_LOADED > LIMITS_TTL:
+        LIMITS_LOADED = time.monotonic()
+        apply_limits(await run_db(_get_limits_sync))
+    return LIMITS
+
+
+async def set_limit_db(op: str, per_min: int, burst: int, concurrency: int):
+    limit = {"per_min": per_min, "burst": burst, "concurrency": concurrency}
+    await run_db(_set_limit_sync, op, limit)
+    apply_limits({**LIMITS, op: limit})
+
+
+async def admit(uid: int, op: str, reply) -> bool:
+    # Per-user rate check; replies with a friendly rejection and returns False when over
+    if uid == OWNER_ID:
+        return True
+    limit = (await get_limits())[op]
+    key = (uid, op)
+    bucket = USER_BUCKETS.get(key)
+    if bucket is None:
+        bucket = TokenBucket(limit["per_min"] / 60, limit["burst"])
+    _lru_put(USER_BUCKETS, key, bucket, ADMISSION_BUCKETS_MAX)
+    if bucket.try_acquire():
+        ADMISSION_STATS[op]["admitted"] += 1
+        return True
+    ADMISSION_STATS[op]["rate_limited"] += 1
+    wait = max(1, int((1 - bucket.tokens) / bucket.rate + 0.999))
+    try:
+        await reply(f"🐢 Slow down! You can do that again in {wait}s.")
+    except Exception as e:
+        print(f"Warning: could not send rate-limit notice: {e}")
+    return False
+
+
+@asynccontextmanager
+async def op_slot(op: str, notify=None):
+    # Global concurrency gate; yields False when the wait queue is full (load shed)
+    gate = OP_GATES[op]
+
+    async def on_queue(position: int):
+        ADMISSION_STATS[op]["queued"] += 1
+        if notify is not None:
+            try:
+                await notify(f"⏳ Lots of requests right now: you're #{position} in the queue...")
+            except Exception:
+                pass  # the notice is best-effort
+
+    if not await gate.acquire(on_queue):
+        ADMISSION_STATS[op]["shed"] += 1
+        yield False
+        return
+    try:
+        yield True
+    finally:
+        gate.release()
+
+
+def admission_metrics() -> Dict[str, Any]:
+    return {op: {**LIMITS[op], "active": OP_GATES[op].active, "waiting": len(OP_GATES[op].waiters), **ADMISSION_STATS[op]}
+            for op in DEFAULT_LIMITS}
+
+
+# -------------------------
+# Interactive sessions
+# -------------------------
+# One session per user for the multi-step flows (/qrgen, /shortner, /qrscan, /broadcast).
+# Sessions expire after a per-flow idle TTL, the store is capped with LRU eviction, and
+# dropping a session releases whatever it holds (pending scan bytes, partial form data).
+SESSION_MAX = int(os.getenv("SESSION_MAX", "10000"))
+SESSION_SWEEP_INTERVAL = 60
+SESSION_DEFAULT_TTL = 600
+SESSION_TTLS = {
+    "qrgen": 900,
+    "shorten": 600,
+    "qrscan_wait": 90,
+    "qrscan_fallback": 300,  # holds the image bytes; keep it short
+    "broadcast_confirm": 900,
+    "broadcast_cancelled": 360,
+}
+
+
+class Session:
+    __slots__ = ("flow", "step", "qr_type", "data", "long_url", "pending_bytes", "scan_keys",
+                 "bc_text", "bc_file_id", "bc_file_type", "expires")
+
+    def __init__(self, flow: str, **fields):
+        for name in self.__slots__:
+            setattr(self, name, None)
+        self.flow = flow
+        for name, value in fields.items():
+            setattr(self, name, value)
+
+    def release(self):
+        # Cleanup hook: drop references to large payloads as soon as the flow ends
+        self.pending_bytes = None
+        self.scan_keys = None
+        self.data = None
+
+    def nbytes(self) -> int:
+        n = sys.getsizeof(self)
+        for name in self.__slots__:
+            value = getattr(self, name)
+            if value is not None and name != "expires":
+                n += sys.getsizeof(value)
+        if self.data:
+            n += sum(sys.getsizeof(v) for v in self.data.values())
+        return n
+
+
+class SessionStore:
+    def __init__(self, max_size: int, ttls: Dict[str, float], default_ttl: float):
+        self.max_size = max_size
+        self.ttls = ttls
+        self.default_ttl = default_ttl
+        self.items: "OrderedDict[int, Session]" = OrderedDict()
+        self.stats = {"started": 0, "ended": 0, "expired": 0, "evicted": 0}
+
+    def _drop(self, uid: int, reason: str):
+        session = self.items.pop(uid, None)
+        if session is not None:
+            session.release()
+            self.stats[reason] += 1
+
+    def _touch(self, uid: int, session: Session):
+        session.expires = time.monotonic() + self.ttls.get(session.flow, self.default_ttl)
+        self.items.move_to_end(uid)
+
+    def start(self, uid: int, flow: str, **fields) -> Session:
+        self._drop(uid, "ended")
+        session = self.items[uid] = Session(flow, **fields)
+        self._touch(uid, session)
+        self.stats["started"] += 1
+        while len(self.items) > self.max_size:
+            self._drop(next(iter(self.items)), "evicted")
+        return session
+
+    def get(self, uid: int, flow: Optional[str] = None) -> Optional[Session]:
+        session = self.items.get(uid)
+        if session is None:
+            return None
+        if session.expires <= time.monotonic():
+            self._drop(uid, "expired")
+            return None
+        if flow is not None and session.flow != flow:
+            return None
+        self._touch(uid, session)
+        return session
+
+    def end(self, uid: int):
+        self._drop(uid, "ended")
+
+    def __contains__(self, uid: int) -> bool:
+        return self.get(uid) is not None
+
+    def sweep(self) -> int:
+        now = time.monotonic()
+        expired = [uid for uid, session in self.items.items() if session.expires <= now]
+        for uid in expired:
+            self._drop(uid, "expired")
+        return len(expired)
+
+    def metrics(self) -> Dict[str, Any]:
+        by_flow: Dict[str, int] = {}
+        for session in self.items.values():
+            by_flow[session.flow] = by_flow.get(session.flow, 0) + 1
+        return {
+            "size": len(self.items), "max": self.max_size, "by_flow": by_flow,
+            "bytes": sum(session.nbytes() for session in self.items.values()),
+            "pending_bytes": sum(len(session.pending_bytes) for session in self.items.values() if session.pending_bytes),
+            **self.stats,
+        }
+
+
+INTERACTIVE = SessionStore(SESSION_MAX, SESSION_TTLS, SESSION_DEFAULT_TTL)
+
+
+async def session_sweep_loop():
+    while True:
+        await asyncio.sleep(SESSION_SWEEP_INTERVAL)
+        try:
+            INTERACTIVE.sweep()
+        except Exception as e:
+            print(f"Error (session_sweep_loop): {e}")
 
 # format uptime: YYYY:MM:DD:HH:MM:SS:ms
 START_TS = time.time()
@@ -351,8 +2067,8 @@ def uptime_str():
 # ---------- /start ----------
 @app.on_message(filters.command("start"))
 async def start_cmd(_, msg: Message):
-    register_user_db(msg.from_user.id)
-    features = get_features_db()
+    await register_user_db(msg.from_user.id)
+    features = await get_features_db()
     txt = (
         f"👋 *QuickLink Utilities Bot*\n\n"
         f"Hi {msg.from_user.first_name}! I can shorten links, generate/scan QRs, and more.\n\n"
@@ -360,6 +2076,7 @@ async def start_cmd(_, msg: Message):
         f"/shortner - Shorten a long URL\n"
         f"/qrgen - Generate a QR code (Text, WiFi, etc.)\n"
         f"/qrscan - Scan a QR code from an image\n"
+        f"/bulkshort - Shorten many URLs at once (text or .txt/.csv)\n"
         f"/chat - Talk to the support AI\n"
         f"/state - Show bot usage stats\n"
         f"/owner - View bot owner's info\n\n"
@@ -371,9 +2088,10 @@ async def start_cmd(_, msg: Message):
 # ---------- /state (Bot Stats) ----------
 @app.on_message(filters.command("state"))
 async def state_cmd(_, msg: Message):
-    register_user_db(msg.from_user.id)
-    stats = get_stats_db()
-    last5 = get_last_urls_db(5) # This just gets the short URL
+    await register_user_db(msg.from_user.id)
+    stats = await get_stats_db()
+    live, dead = await count_users_db()
+    last5 = await get_last_urls_db(5) # This just gets the short URL
     
     last_text = ""
     if last5:
@@ -387,7 +2105,8 @@ async def state_cmd(_, msg: Message):
         f"📊 *Quicklink Bot Stats*\n\n"
         f"• Total URLs Shortened: {stats.get('shorten',0)}\n"
         f"• QR Generated: {stats.get('qrgen',0)}\n"
-        f"• QR Scanned: {stats.get('qrscan',0)}\n\n"
+        f"• QR Scanned: {stats.get('qrscan',0)}\n"
+        f"• Users: {live} active, {dead} blocked/deleted\n\n"
         f"🕐 *Recent Shortened URLs:*\n{last_text}"
     )
     await msg.reply_text(txt)
@@ -396,23 +2115,42 @@ async def state_cmd(_, msg: Message):
 # ---------- /chat (Chatbase) ----------
 @app.on_message(filters.command("chat"))
 async def chat_cmd(_, msg: Message):
-    if not get_features_db().get("chat", True):
+    if not (await get_features_db()).get("chat", True):
         return await msg.reply_text("⚠️ This feature is temporarily disabled by the admin.")
     
-    register_user_db(msg.from_user.id)
+    await register_user_db(msg.from_user.id)
     if len(msg.command) < 2:
         return await msg.reply_text("Usage: `/chat <your message>`\nExample: `/chat How does the URL shortener work?`")
     
+    if not await admit(msg.from_user.id, "chat", msg.reply_text):
+        return
     user_msg = msg.text.split(" ",1)[1]
-    await msg.reply_text("💬 Asking AI... (this may take a moment)", quote=True)
-    # Run the blocking network request in an executor
-    res = await asyncio.get_event_loop().run_in_executor(None, partial(chatbase_query, user_msg))
-    await msg.reply_text(f"🧠 **AI Support:**\n\n{res}")
+    status = await msg.reply_text("💬 Asking AI... (this may take a moment)", quote=True)
+    last_edit = 0.0
+
+    async def on_partial(text: str):
+        # Progressive edits, throttled to stay under Telegram's edit rate limits
+        nonlocal last_edit
+        if time.monotonic() - last_edit < CHAT_EDIT_INTERVAL or not text.strip():
+            return
+        last_edit = time.monotonic()
+        try:
+            await status.edit_text(f"🧠 **AI Support:**\n\n{text[:CHAT_MAX_CHARS]} ▌")
+        except FloodWait as e:
+            last_edit = time.monotonic() + e.value  # back off instead of stalling the stream
+        except Exception:
+            pass  # e.g. "message not modified"; the final edit below settles it
+
+    async with op_slot("chat", status.edit_text) as ok:
+        if not ok:
+            return await status.edit_text(ADMISSION_BUSY_TEXT)
+        res = await chatbase_query(user_msg, on_partial=on_partial)
+    await status.edit_text(f"🧠 **AI Support:**\n\n{res[:CHAT_MAX_CHARS]}")
 
 
 # ---------- Admin /admin toggles (Owner Panel) ----------
-def feature_keyboard():
-    f = get_features_db()
+async def feature_keyboard():
+    f = await get_features_db()
     kb = InlineKeyboardMarkup([
         [
             InlineKeyboardButton(f"Shortener: {'✅ ON' if f.get('shorten') else '❌ OFF'}", callback_data="ft|shorten"),
@@ -425,6 +2163,9 @@ def feature_keyboard():
         [
             InlineKeyboardButton(f"Broadcast: {'✅ ON' if f.get('broadcast') else '❌ OFF'}", callback_data="ft|broadcast")
         ],
+        [
+            InlineKeyboardButton(f"🧹 Flush Chat Cache ({len(CHAT_CACHE)})", callback_data="adm|flush_chat")
+        ],
     ])
     return kb
 
@@ -433,7 +2174,21 @@ def feature_keyboard():
 async def admin_cmd(_, msg: Message):
     if msg.from_user.id != OWNER_ID:
         return await msg.reply_text("❌ You are not the owner.")
-    await msg.reply_text("🔑 *Admin Control Panel*\nToggle features on or off for all users:", reply_markup=feature_keyboard())
+    args = msg.command[1:]
+    if args and args[0] in ("limit", "limits"):
+        return await admin_limit(msg, args[1:])
+    await msg.reply_text("🔑 *Admin Control Panel*\nToggle features on or off for all users:\n(Rate limits: `/admin limit`)", reply_markup=await feature_keyboard())
+
+
+async def admin_limit(msg: Message, args: List[str]):
+    # /admin limit <op> <per_min> <burst> <concurrency>; no arguments lists the current limits
+    if args:
+        if len(args) != 4 or args[0] not in DEFAULT_LIMITS or not all(a.isdigit() and int(a) > 0 for a in args[1:]):
+            return await msg.reply_text(f"Usage: `/admin limit <op> <per_min> <burst> <concurrency>`\nOps: {', '.join(DEFAULT_LIMITS)}")
+        await set_limit_db(args[0], *(int(a) for a in args[1:]))
+    limits = await get_limits()
+    lines = [f"• `{op}`: {v['per_min']}/min, burst {v['burst']}, {v['concurrency']} at once" for op, v in limits.items()]
+    await msg.reply_text("🚦 *Limits* (per user / global)\n\n" + "\n".join(lines))
 
 
 @app.on_callback_query(filters.regex(r"^ft\|"))
@@ -443,22 +2198,259 @@ async def feature_toggle(_, cq):
         return await cq.answer("Not allowed", show_alert=True)
     
     key = cq.data.split("|",1)[1]
-    features = get_features_db()
+    features = await get_features_db()
     # Flip the boolean value
     new_val = not features.get(key, True)
-    set_feature_db(key, new_val)
+    await set_feature_db(key, new_val)
     
     # Edit message with new keyboard
-    await cq.message.edit_text("🔑 *Admin Control Panel*\nSettings updated!", reply_markup=feature_keyboard())
+    await cq.message.edit_text("🔑 *Admin Control Panel*\nSettings updated!", reply_markup=await feature_keyboard())
     await cq.answer(f"{key.title()} is now {'ON' if new_val else 'OFF'}")
 
 
+@app.on_callback_query(filters.regex(r"^adm\|flush_chat$"))
+async def flush_chat_cache_cb(_, cq):
+    if cq.from_user.id != OWNER_ID:
+        return await cq.answer("Not allowed", show_alert=True)
+    n = await chat_cache_flush_all()
+    await cq.message.edit_text("🔑 *Admin Control Panel*\nChat cache flushed!", reply_markup=await feature_keyboard())
+    await cq.answer(f"Removed {n} cached answers here; other workers follow within {CHAT_CACHE_GEN_TTL}s")
+
+
+# ---------- /qrbench (owner only): QR profile size vs encode time ----------
+@app.on_message(filters.command("qrbench"))
+async def qrbench_cmd(_, msg: Message):
+    if msg.from_user.id != OWNER_ID:
+        return await msg.reply_text("❌ You are not the owner.")
+    sample = msg.text.split(" ",1)[1] if len(msg.command) > 1 else "upi://pay?pa=shop@upi&pn=QuickLink%20Store&am=250.00&tn=Order%2012345"
+    try:
+        rows = await QR_QUEUE.submit(bench_qr_profiles, sample, priority=PRIORITY_BULK)
+    except CpuQueueFull:
+        return await msg.reply_text(ADMISSION_BUSY_TEXT)
+    lines = [f"• `{r['profile']}`: {r['bytes']/1024:.1f} KB, {r['ms']:.1f} ms" for r in rows]
+    await msg.reply_text("📐 *QR Profile Benchmark*\n\n" + "\n".join(lines))
+
+
+# ---------- /scanplan (owner only): reply to a photo to see what /qrscan downloads ----------
+@app.on_message(filters.command("scanplan"))
+async def scanplan_cmd(_, msg: Message):
+    if msg.from_user.id != OWNER_ID:
+        return await msg.reply_text("❌ You are not the owner.")
+    got = msg.reply_to_message
+    if not got or not got.photo:
+        return await msg.reply_text("Reply to a photo with /scanplan.")
+    lines = []
+    for label, file_id in scan_download_plan(got):
+        t0 = time.perf_counter()
+        try:
+            data = await download_scan_image(got, file_id)
+            res, stage = await DECODE_QUEUE.submit(local_scan_qr, data, priority=PRIORITY_BULK)
+        except Exception as e:
+            lines.append(f"• `{label}`: failed ({e})")
+            continue
+        size = "x".join(map(str, Image.open(io.BytesIO(data)).size))
+        lines.append(f"• `{label}` → {size}, {len(data)/1024:.1f} KB, {(time.perf_counter() - t0) * 1000:.0f} ms, "
+                     f"{'decoded at ' + stage if res else 'no decode'}")
+    await msg.reply_text("🔬 *Scan Download Plan*\n\n" + "\n".join(lines))
+
+
+# ---------- Broadcast engine ----------
+# Broadcasts are persisted jobs: users are streamed by _id cursor in batches, each batch
+# is delivered by a pool of concurrent senders behind one global token bucket, and the
+# cursor + counters are checkpointed after every batch. On restart, unfinished jobs
+# resume from the last checkpoint, so at most one batch can be re-sent.
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "25"))  # msgs/s; Telegram allows ~30/s for bots
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "20"))
+BROADCAST_BATCH = int(os.getenv("BROADCAST_BATCH", "200"))
+BROADCAST_PROGRESS_INTERVAL = 5.0
+BROADCAST_STOP: set = set()  # job ids asked to stop
+BROADCAST_RUNNING: Dict[str, asyncio.Task] = {}
+
+
+async def send_broadcast_message(job: Dict[str, Any], user_id: int):
+    text, file_id, file_type = job.get("text"), job.get("file_id"), job.get("file_type")
+    if file_type == "photo":
+        await app.send_photo(user_id, photo=file_id, caption=text)
+    elif file_type == "video":
+        await app.send_video(user_id, video=file_id, caption=text)
+    elif file_type == "document":
+        await app.send_document(user_id, document=file_id, caption=text)
+    else:
+        await app.send_message(user_id, text)
+
+
+# Delivery failures that will never succeed: the user is marked dead and skipped by
+# future broadcast cursors until they talk to the bot again.
+DEAD_ERRORS = {
+    UserIsBlocked: "blocked",
+    InputUserDeactivated: "deactivated",
+    UserDeactivated: "deactivated",
+    UserDeactivatedBan: "deactivated",
+}
+# PeerIdInvalid is deliberately not here: it means this worker's session cannot resolve
+# the peer (e.g. a fresh session file after a restart), not that the user is gone.
+
+
+def classify_send_error(e: Exception) -> str:
+    for exc_type, reason in DEAD_ERRORS.items():
+        if isinstance(e, exc_type):
+            return reason
+    return "transient"
+
+
+async def deliver_broadcast(job: Dict[str, Any], user_id: int, limiter: TokenBucket) -> Optional[str]:
+    # None when sent, otherwise the failure class from classify_send_error
+    for _ in range(3):
+        await limiter.acquire()
+        try:
+            await send_broadcast_message(job, user_id)
+            return None
+        except FloodWait as e:
+            wait = min(int(e.value) + 1, 300)
+            print(f"FloodWait: pausing broadcast limiter for {wait}s")
+            limiter.pause(wait)
+        except Exception as e:
+            reason = classify_send_error(e)
+            if reason == "transient":
+                print(f"Broadcast failed to user {user_id}: {e}")
+            return reason
+    return "transient"
+
+
+def broadcast_progress_text(job: Dict[str, Any], rate: float, header: str = "🚀 *Broadcast Running*") -> str:
+    done = job["sent"] + job["failed"] + job["dead"]
+    total = max(job.get("total", 0), done)
+    eta = int((total - done) / rate) if rate > 0 else 0
+    return (f"{header}\n\nSent: {job['sent']}\nFailed: {job['failed']}\nBlocked/Deleted: {job['dead']}\n"
+            f"Progress: {done}/{total}\nThroughput: {rate:.1f} msg/s\nETA: {eta // 60}m {eta % 60}s")
+
+
+async def edit_broadcast_status(job: Dict[str, Any], text: str, running: bool = True):
+    kb = InlineKeyboardMarkup([[InlineKeyboardButton("⏹ Stop Broadcast", callback_data=f"bc|stop|{job['_id']}")]]) if running else None
+    try:
+        await app.edit_message_text(job["chat_id"], job["message_id"], text, reply_markup=kb)
+    except FloodWait:
+        pass  # progress is best-effort
+    except Exception as e:
+        print(f"Warning: broadcast progress edit failed: {e}")
+
+
+async def run_broadcast_job(job: Dict[str, Any]):
+    job_id = job["_id"]
+    limiter = TokenBucket(BROADCAST_RATE, burst=BROADCAST_RATE)
+    sem = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+    if not job.get("total"):
+        job["total"] = (await count_users_db())[0]
+    job["status"] = "running"
+    job.setdefault("started", time.time())
+    job.setdefault("dead", 0)
+    await save_broadcast_db(job)
+    t0, done0, last_progress = time.monotonic(), job["sent"] + job["failed"] + job["dead"], 0.0
+    dead: Dict[int, str] = {}
+
+    def current_rate() -> float:
+        elapsed = time.monotonic() - t0
+        return (job["sent"] + job["failed"] + job["dead"] - done0) / elapsed if elapsed > 0 else 0.0
+
+    async def send_one(user_id: int):
+        nonlocal last_progress
+        async with sem:
+            reason = await deliver_broadcast(job, user_id, limiter)
+        if reason is None:
+            job["sent"] += 1
+        elif reason == "transient":
+            job["failed"] += 1
+        else:
+            job["dead"] += 1
+            dead[user_id] = reason
+        if time.monotonic() - last_progress >= BROADCAST_PROGRESS_INTERVAL:
+            last_progress = time.monotonic()
+            await edit_broadcast_status(job, broadcast_progress_text(job, current_rate()))
+
+    try:
+        while IS_LEADER:
+            if job_id in BROADCAST_STOP or await broadcast_stop_requested_db(job_id):
+                BROADCAST_STOP.add(job_id)
+                break
+            batch = await get_user_batch_db(job.get("cursor"), BROADCAST_BATCH)
+            if not batch:
+                break
+            await asyncio.gather(*(send_one(u) for u in batch))
+            await mark_users_dead_db(dead)
+            dead.clear()
+            job["cursor"] = batch[-1]  # checkpoint: everything up to here was attempted
+            await save_broadcast_db(job)
+        if not IS_LEADER and job_id not in BROADCAST_STOP:
+            # Lost the lease mid-job: the new leader resumes from the last checkpoint
+            print(f"Broadcast job {job_id} handed over: no longer leader")
+            return
+
+        stopped = job_id in BROADCAST_STOP
+        BROADCAST_STOP.discard(job_id)
+        job["status"] = "cancelled" if stopped else "done"
+        job["finished"] = time.time()
+        await save_broadcast_db(job)
+        # Store last broadcast time
+        await set_last_broadcast_db(int(time.time()))
+        took = int(job["finished"] - job["started"])
+        header = "⏹ *Broadcast Stopped*" if stopped else "✅ *Broadcast Completed*"
+        await edit_broadcast_status(job, f"{broadcast_progress_text(job, current_rate(), header)}\nTime Taken: {took}s", running=False)
+    except Exception as e:
+        # Leave the job "running" so it resumes from the last checkpoint on restart
+        print(f"Broadcast job {job_id} interrupted: {e}")
+        await save_broadcast_db(job)
+    finally:
+        # Only after the terminal status is saved: a leader_loop tick in between would
+        # otherwise see the job "running" in storage and start it a second time
+        BROADCAST_RUNNING.pop(job_id, None)
+
+
+def start_broadcast_job(job: Dict[str, Any]):
+    if job["_id"] not in BROADCAST_RUNNING:
+        BROADCAST_RUNNING[job["_id"]] = spawn_bg(run_broadcast_job(job))
+
+
+async def resume_broadcasts():
+    for job in await get_active_broadcasts_db():
+        if job["_id"] in BROADCAST_RUNNING:
+            continue
+        print(f"{'Starting' if job['status'] == 'queued' else 'Resuming'} broadcast {job['_id']} from user cursor {job.get('cursor')}")
+        start_broadcast_job(job)
+
+
+# Leader election: broadcasts are singleton work, run only by the worker holding a lease
+# in the shared store (Mongo config doc, or the SQLite config table for local workers).
+# The leader also picks up jobs queued by other workers.
+LEADER_LEASE = float(os.getenv("LEADER_LEASE", "30"))
+LEADER_RENEW_INTERVAL = LEADER_LEASE / 3
+IS_LEADER = False
+
+
+async def leader_loop():
+    global IS_LEADER
+    while True:
+        try:
+            leader = await run_db(_acquire_leader_sync, WORKER_ID, LEADER_LEASE)
+        except Exception as e:
+            print(f"Error (leader_loop): {e}")
+            leader = False
+        if leader != IS_LEADER:
+            print(f"Worker {WORKER_INDEX} ({WORKER_ID}) {'acquired' if leader else 'lost'} leadership")
+        IS_LEADER = leader
+        if IS_LEADER:
+            try:
+                await resume_broadcasts()
+            except Exception as e:
+                print(f"Error (resume_broadcasts): {e}")
+        await asyncio.sleep(LEADER_RENEW_INTERVAL)
+
+
 # ---------- /broadcast (owner only) ----------
 @app.on_message(filters.command("broadcast"))
 async def broadcast_start(_, msg: Message):
     if msg.from_user.id != OWNER_ID:
         return await msg.reply_text("❌ Only owner can broadcast.")
-    if not get_features_db().get("broadcast", True):
+    if not (await get_features_db()).get("broadcast", True):
         return await msg.reply_text("⚠️ Broadcast feature disabled by admin.")
     
     await msg.reply_text("📨 *New Broadcast*\nSend the message you want to broadcast (text, photo, or video). You have 5 minutes.",
@@ -473,8 +2465,8 @@ async def broadcast_start(_, msg: Message):
         return await msg.reply_text("⏰ Timeout. Broadcast cancelled.")
     
     # Check if user cancelled with the button
-    if INTERACTIVE.get(msg.from_user.id, {}).get("flow") == "broadcast_cancelled":
-        INTERACTIVE.pop(msg.from_user.id, None)
+    if INTERACTIVE.get(msg.from_user.id, "broadcast_cancelled"):
+        INTERACTIVE.end(msg.from_user.id)
         return await msg.reply_text("Broadcast cancelled.")
 
     text = bmsg.caption or bmsg.text or ""
@@ -492,12 +2484,7 @@ async def broadcast_start(_, msg: Message):
         file_type = "document"
     
     # Store message info for confirmation
-    INTERACTIVE[msg.from_user.id] = {
-        "flow": "broadcast_confirm",
-        "bc_text": text, 
-        "bc_file_id": file_id,
-        "bc_file_type": file_type
-    }
+    INTERACTIVE.start(msg.from_user.id, "broadcast_confirm", bc_text=text, bc_file_id=file_id, bc_file_type=file_type)
     
     kb = InlineKeyboardMarkup([
         [InlineKeyboardButton("✅ Yes, Send Now", callback_data="bc|confirm")],
@@ -509,7 +2496,7 @@ async def broadcast_start(_, msg: Message):
 async def broadcast_cancel_listen(_, cq):
     if cq.from_user.id != OWNER_ID:
         return await cq.answer("Not allowed", show_alert=True)
-    INTERACTIVE[cq.from_user.id] = {"flow": "broadcast_cancelled"}
+    INTERACTIVE.start(cq.from_user.id, "broadcast_cancelled")
     await cq.message.edit_text("Broadcast cancelled.")
 
 
@@ -520,101 +2507,69 @@ async def broadcast_cb(_, cq):
         return await cq.answer("Not allowed", show_alert=True)
     
     action = cq.data.split("|",1)[1]
-    state = INTERACTIVE.get(uid)
+    state = INTERACTIVE.get(uid, "broadcast_confirm")
     
-    if not state or state.get("flow") != "broadcast_confirm":
+    if not state:
         return await cq.answer("Nothing to send or session expired.", show_alert=True)
     
     if action == "cancel":
-        INTERACTIVE.pop(uid, None)
+        INTERACTIVE.end(uid)
         return await cq.message.edit_text("Broadcast cancelled.")
 
     await cq.message.edit_text("🚀 Broadcast starting... This may take several minutes.\nI will send a final report when done.")
 
-    users = get_all_users_db()
-    total = len(users)
+    total, _ = await count_users_db()
     if total == 0:
-        INTERACTIVE.pop(uid, None)
+        INTERACTIVE.end(uid)
         return await cq.message.edit_text("No registered users to send.")
 
-    # Get message content from state
-    text = state.get("bc_text")
-    file_id = state.get("bc_file_id")
-    file_type = state.get("bc_file_type")
-
-    # Define the send function
-    async def send_message(user_id):
-        if file_type == "photo":
-            await app.send_photo(user_id, photo=file_id, caption=text)
-        elif file_type == "video":
-            await app.send_video(user_id, video=file_id, caption=text)
-        elif file_type == "document":
-            await app.send_document(user_id, document=file_id, caption=text)
-        else:
-            await app.send_message(user_id, text)
+    # Persist the job first so it survives restarts, then hand it to the engine
+    job = {
+        "_id": secrets.token_hex(6), "status": "queued", "created": time.time(),
+        "text": state.bc_text, "file_id": state.bc_file_id, "file_type": state.bc_file_type,
+        "chat_id": cq.message.chat.id, "message_id": cq.message.id,
+        "cursor": None, "sent": 0, "failed": 0, "dead": 0, "total": total,
+    }
+    INTERACTIVE.end(uid)
+    await save_broadcast_db(job)
+    if IS_LEADER:
+        start_broadcast_job(job)
+    # Otherwise the leader worker picks the queued job up on its next lease renewal
 
-    # compute base interval
-    base_interval = 300.0 / total # Aim to finish in ~5 minutes
-    interval = max(0.05, min(2.0, base_interval))  # 50ms min, 2s max
 
-    sent = 0
-    failed = 0
-    start_t = time.time()
-    
-    for user in users:
-        try:
-            await send_message(user)
-            sent += 1
-        except FloodWait as e:
-            wait = min(int(e.x) + 2, 300)
-            print(f"FloodWait: sleeping for {wait}s")
-            await asyncio.sleep(wait)
-            try:
-                await send_message(user)
-                sent += 1
-            except Exception as e2:
-                print(f"Broadcast failed to user {user} after FloodWait: {e2}")
-                failed += 1
-        except Exception as e3:
-            # Catch common errors like "user blocked bot"
-            print(f"Broadcast failed to user {user}: {e3}")
-            failed += 1
-        
-        # Sleep between sends to avoid hitting limits
-        await asyncio.sleep(interval) 
-        
-    end_t = time.time()
-    INTERACTIVE.pop(uid, None)
-    
-    # Store last broadcast time
-    if mongo_ok:
-        try:
-            DB["config"].update_one({"_id":"last_broadcast"}, {"$set":{"ts":int(time.time())}}, upsert=True)
-        except Exception: pass
-    else:
-        LOCAL["last_broadcast"] = int(time.time()); save_storage_local(LOCAL)
-        
-    await cq.message.edit_text(f"✅ *Broadcast Completed*\n\nSent: {sent}\nFailed: {failed}\nTotal Users: {total}\nTime Taken: {int(end_t-start_t)}s")
+@app.on_callback_query(filters.regex(r"^bc\|stop\|"))
+async def broadcast_stop_cb(_, cq):
+    if cq.from_user.id != OWNER_ID:
+        return await cq.answer("Not allowed", show_alert=True)
+    job_id = cq.data.split("|",2)[2]
+    # The job may be running on another worker (the leader): signal through storage
+    BROADCAST_STOP.add(job_id)
+    await request_broadcast_stop_db(job_id)
+    await cq.answer("Stopping after the current batch...")
 
 
 # ---------- QR generation/interactive flows ----------
 # Matches your feature list
+# (label, type, output profile from QR_PROFILES)
 QR_TYPES = [
-    ("Text", "text"), ("Link", "link"), ("WiFi", "wifi"), ("Email", "email"),
-    ("Phone", "phone"), ("WhatsApp", "whatsapp"), ("UPI", "upi"), ("SMS", "message")
+    ("Text", "text", QR_DEFAULT_PROFILE), ("Link", "link", QR_DEFAULT_PROFILE),
+    ("WiFi", "wifi", QR_DEFAULT_PROFILE), ("Email", "email", QR_DEFAULT_PROFILE),
+    ("Phone", "phone", QR_DEFAULT_PROFILE), ("WhatsApp", "whatsapp", QR_DEFAULT_PROFILE),
+    ("UPI", "upi", "print"), ("SMS", "message", QR_DEFAULT_PROFILE)
 ]
+QR_TYPE_PROFILES = {val: profile for _, val, profile in QR_TYPES}
 
 @app.on_message(filters.command("qrgen"))
 async def qrgen_start(_, msg: Message):
-    if not get_features_db().get("qrgen", True):
+    if not (await get_features_db()).get("qrgen", True):
         return await msg.reply_text("⚠️ This feature is temporarily disabled by the admin.")
     
-    register_user_db(msg.from_user.id)
+    await register_user_db(msg.from_user.id)
     
     # Create 4x2 button layout
     buttons = []
     row = []
-    for label, val in QR_TYPES:
+    for label, val, _ in QR_TYPES:
         row.append(InlineKeyboardButton(label, callback_data=f"qrtype|{val}"))
         if len(row) == 2: # 2 buttons per row
             buttons.append(row)
@@ -631,7 +2586,9 @@ async def qrtype_cb(_, cq):
     user_id = cq.from_user.id
     _, qrtype = cq.data.split("|",1)
     
-    INTERACTIVE[user_id] = {"flow":"qrgen", "type": qrtype, "data": {}}
+    if not await admit(user_id, "qrgen", cq.message.edit_text):
+        return await cq.answer()
+    INTERACTIVE.start(user_id, "qrgen", qr_type=qrtype, data={})
     await cq.answer()
     # This dictionary was not closed properly. Here is the corrected version.
     prompts = {
@@ -650,32 +2607,29 @@ async def qrtype_cb(_, cq):
 # We must define all commands here to exclude them from the private message handler
 ALL_COMMANDS = [
     "start", "state", "chat", "admin", "broadcast", 
-    "qrgen", "qrscan", "shortner", "owner"
+    "qrgen", "qrscan", "shortner", "owner", "qrbench", "bulkshort", "scanplan"
 ]
 
 @app.on_message(filters.private & ~filters.command(ALL_COMMANDS)) # Catches all non-command messages
 async def private_flow_handler(_, msg: Message):
     uid = msg.from_user.id
-    if uid not in INTERACTIVE:
-        # User is not in a flow
-        await msg.reply_text("I'm not sure what you mean. Try /start to see available commands.")
-        return
-    
     state = INTERACTIVE.get(uid)
     if not state:
-        return # Safeguard
+        # User is not in a flow (or it expired)
+        await msg.reply_text("I'm not sure what you mean. Try /start to see available commands.")
+        return
 
-    if state.get("flow") == "qrgen":
+    if state.flow == "qrgen":
         await handle_qrgen_step(msg, state)
-    elif state.get("flow") == "shorten":
+    elif state.flow == "shorten":
         await handle_shorten_step(msg, state)
     # qrscan_wait is handled by `app.listen` in the /qrscan command itself
     # broadcast is handled by `app.listen` in the /broadcast command
 
 
-async def handle_qrgen_step(msg: Message, state: Dict):
+async def handle_qrgen_step(msg: Message, state: Session):
     uid = msg.from_user.id
-    typ = state["type"]; d = state["data"]
+    typ = state.qr_type; d = state.data
     try:
         # --- Text / Link ---
         if typ in ("text","link"):
@@ -685,10 +2639,9 @@ async def handle_qrgen_step(msg: Message, state: Dict):
                 if not qr_text:
                     await msg.reply_text("Please send valid text/link.")
                     return
-                png = build_qr_png_bytes(qr_text, size=1000)
-                await msg.reply_photo(png, caption=f"✅ *QR Generated Successfully!*\nType: {typ.title()}\n\n`{qr_text}`")
-                inc_stat_db("qrgen");
-                return INTERACTIVE.pop(uid, None)
+                if await send_qr_photo(msg, qr_text, caption=f"✅ *QR Generated Successfully!*\nType: {typ.title()}\n\n`{qr_text}`", profile_name=QR_TYPE_PROFILES[typ]):
+                    await inc_stat_db("qrgen")
+                return INTERACTIVE.end(uid)
         
         # --- WiFi ---
         if typ == "wifi":
@@ -712,14 +2665,16 @@ async def handle_qrgen_step(msg: Message, state: Dict):
             if "body" not in d:
                 d["body"] = msg.text if (msg.text and msg.text!="-") else ""
                 mailto = f"mailto:{d['to']}?subject={urllib.parse.quote(d['subject'])}&body={urllib.parse.quote(d['body'])}"
-                png = build_qr_png_bytes(mailto, size=1000)
-                await msg.reply_photo(png, caption=f"✅ *QR Generated Successfully!*\nType: Email")
-                inc_stat_db("qrgen"); return INTERACTIVE.pop(uid, None)
+                if await send_qr_photo(msg, mailto, caption=f"✅ *QR Generated Successfully!*\nType: Email", profile_name=QR_TYPE_PROFILES[typ]):
+                    await inc_stat_db("qrgen")
+                return INTERACTIVE.end(uid)
         
         # --- Phone ---
         if typ == "phone":
-            d["phone"] = msg.text or ""; tel = f"tel:{d['phone']}"; png = build_qr_png_bytes(tel,1000)
-            await msg.reply_photo(png, caption=f"✅ *QR Generated Successfully!*\nType: Phone\n\n`{tel}`"); inc_stat_db("qrgen"); return INTERACTIVE.pop(uid, None)
+            d["phone"] = msg.text or ""; tel = f"tel:{d['phone']}"
+            if await send_qr_photo(msg, tel, caption=f"✅ *QR Generated Successfully!*\nType: Phone\n\n`{tel}`", profile_name=QR_TYPE_PROFILES[typ]):
+                await inc_stat_db("qrgen")
+            return INTERACTIVE.end(uid)
         
         # --- WhatsApp ---
         if typ == "whatsapp":
@@ -728,9 +2683,9 @@ async def handle_qrgen_step(msg: Message, state: Dict):
             if "message" not in d:
                 d["message"] = msg.text if (msg.text and msg.text!="-") else ""
                 wa = f"https://wa.me/{d['number']}?text={urllib.parse.quote(d['message'])}"
-                png = build_qr_png_bytes(wa,1000)
-                await msg.reply_photo(png, caption=f"✅ *QR Generated Successfully!*\nType: WhatsApp")
-                inc_stat_db("qrgen"); return INTERACTIVE.pop(uid, None)
+                if await send_qr_photo(msg, wa, caption=f"✅ *QR Generated Successfully!*\nType: WhatsApp", profile_name=QR_TYPE_PROFILES[typ]):
+                    await inc_stat_db("qrgen")
+                return INTERACTIVE.end(uid)
         
         # --- UPI ---
         if typ == "upi":
@@ -743,9 +2698,9 @@ async def handle_qrgen_step(msg: Message, state: Dict):
             if "tn" not in d: # Transaction Note
                 d["tn"] = msg.text if (msg.text and msg.text!="-") else ""
                 upi = f"upi://pay?pa={urllib.parse.quote(d['pa'])}&pn={urllib.parse.quote(d['pn'])}&am={urllib.parse.quote(d['am'])}&tn={urllib.parse.quote(d['tn'])}"
-                png = build_qr_png_bytes(upi,1000)
-                await msg.reply_photo(png, caption=f"✅ *QR Generated Successfully!*\nType: UPI")
-                inc_stat_db("qrgen"); return INTERACTIVE.pop(uid, None)
+                if await send_qr_photo(msg, upi, caption=f"✅ *QR Generated Successfully!*\nType: UPI", profile_name=QR_TYPE_PROFILES[typ]):
+                    await inc_stat_db("qrgen")
+                return INTERACTIVE.end(uid)
 
         # --- SMS / Message ---
         if typ == "message":
@@ -754,13 +2709,14 @@ async def handle_qrgen_step(msg: Message, state: Dict):
             if "text" not in d:
                 d["text"] = msg.text or ""
                 smsto = f"SMSTO:{d['phone']}:{d['text']}"
-                png = build_qr_png_bytes(smsto,1000)
-                await msg.reply_photo(png, caption=f"✅ *QR Generated Successfully!*\nType: SMS\n\n`{smsto}`"); inc_stat_db("qrgen"); return INTERACTIVE.pop(uid, None)
+                if await send_qr_photo(msg, smsto, caption=f"✅ *QR Generated Successfully!*\nType: SMS\n\n`{smsto}`", profile_name=QR_TYPE_PROFILES[typ]):
+                    await inc_stat_db("qrgen")
+                return INTERACTIVE.end(uid)
                 
     except Exception as e:
         print(f"Error in handle_qrgen_step (uid {uid}, type {typ}): {e}")
         await msg.reply_text("An error occurred. Flow cancelled.")
-        INTERACTIVE.pop(uid, None)
+        INTERACTIVE.end(uid)
 
 
 @app.on_callback_query(filters.regex(r"^wifisec\|"))
@@ -768,10 +2724,10 @@ async def wifisec_cb(_, cq):
     uid = cq.from_user.id; await cq.answer()
     _, sec = cq.data.split("|",1)
     
-    st = INTERACTIVE.get(uid)
-    if not st or st.get("flow")!="qrgen": return await cq.message.edit_text("Session expired.")
+    st = INTERACTIVE.get(uid, "qrgen")
+    if not st: return await cq.message.edit_text("Session expired.")
     
-    d = st["data"]; ssid = d.get("ssid",""); pwd = d.get("password","")
+    d = st.data; ssid = d.get("ssid",""); pwd = d.get("password","")
     # Handle 'None' security
     if sec == "NONE":
         secv = "nopass" # 'nopass' is the correct type for no password
@@ -780,20 +2736,22 @@ async def wifisec_cb(_, cq):
         secv = sec # WPA or WEP
         
     wifi_text = f"WIFI:T:{secv};S:{ssid};P:{pwd};;"
-    png = build_qr_png_bytes(wifi_text,1000)
     await cq.message.delete() # Delete the "Choose Security" message
-    await cq.message.reply_photo(png, caption=f"✅ *QR Generated Successfully!*\nType: WiFi\nSSID: {ssid}")
-    inc_stat_db("qrgen"); return INTERACTIVE.pop(uid, None)
+    if await send_qr_photo(cq.message, wifi_text, caption=f"✅ *QR Generated Successfully!*\nType: WiFi\nSSID: {ssid}", profile_name=QR_TYPE_PROFILES["wifi"]):
+        await inc_stat_db("qrgen")
+    return INTERACTIVE.end(uid)
 
 
 # ---------- /qrscan ----------
 @app.on_message(filters.command("qrscan"))
 async def qrscan_start(_, msg: Message):
-    if not get_features_db().get("qrscan", True):
+    if not (await get_features_db()).get("qrscan", True):
         return await msg.reply_text("⚠️ This feature is temporarily disabled by the admin.")
     
-    register_user_db(msg.from_user.id)
-    uid = msg.from_user.id; INTERACTIVE[uid] = {"flow":"qrscan_wait"}
+    await register_user_db(msg.from_user.id)
+    if not await admit(msg.from_user.id, "qrscan", msg.reply_text):
+        return
+    uid = msg.from_user.id; INTERACTIVE.start(uid, "qrscan_wait")
     
     prompt = await msg.reply_text("📸 Send QR image within 60s.")
     # We don't need a live timer, just a timeout on the listener
@@ -802,34 +2760,71 @@ async def qrscan_start(_, msg: Message):
         # We use app.listen to wait for the *next* message in this chat
         got = await app.listen(chat_id=msg.chat.id, timeout=60, filters=filters.photo | filters.document)
     except asyncio.TimeoutError:
-        INTERACTIVE.pop(uid, None); return await prompt.edit_text("⏰ Timeout — no image received. Scan cancelled.")
+        INTERACTIVE.end(uid); return await prompt.edit_text("⏰ Timeout — no image received. Scan cancelled.")
     
     # Check if the received message is actually a photo or document
     if not (got.photo or (got.document and got.document.mime_type and "image" in got.document.mime_type)):
-        INTERACTIVE.pop(uid, None); return await prompt.edit_text("That's not an image. Scan cancelled. Try /qrscan again.")
-
-    fpath = temp_path_for("qrscan",".png")
-    try:
-        await prompt.edit_text("Downloading image...")
-        await got.download(file_name=fpath)
-    except Exception as e:
-        print(f"Error downloading file: {e}")
-        INTERACTIVE.pop(uid, None)
-        return await prompt.edit_text("Error downloading file. Please try again.")
-
-    await prompt.edit_text("🔎 Scanning locally (using zbar)...")
-    loop = asyncio.get_event_loop()
-    local_res = await loop.run_in_executor(None, partial(local_scan_qr, fpath))
-    inc_stat_db("qrscan")
+        INTERACTIVE.end(uid); return await prompt.edit_text("That's not an image. Scan cancelled. Try /qrscan again.")
+
+    # Same Telegram file seen before: answer without downloading anything
+    media = got.photo or got.document
+    fu_keys = scan_cache_keys(file_unique_id=media.file_unique_id)
+    cached = await get_scan_result(fu_keys)
+    if cached:
+        INTERACTIVE.end(uid)
+        await inc_stat_db("qrscan")
+        return await prompt.edit_text(f"✅ *Decode Success ({cached['source']}, cached):*\n\n`{chr(10).join(cached['results'])}`")
+
+    # Smallest photo size likely to decode first; larger ones only if that fails
+    SCAN_DOWNLOAD_STATS["scans"] += 1
+    local_res, stage = [], None
+    for label, file_id in scan_download_plan(got):
+        try:
+            await prompt.edit_text("Downloading image..." if label == "full" else f"Downloading image ({label})...")
+            # In-memory download: no temp file on the happy path
+            image_bytes = await download_scan_image(got, file_id)
+        except Exception as e:
+            print(f"Error downloading file ({label}): {e}")
+            if label != "full":
+                continue  # size missing for this photo: move on to the next one
+            INTERACTIVE.end(uid)
+            return await prompt.edit_text("Error downloading file. Please try again.")
+
+        # Different upload of identical bytes (e.g. re-sent as a document)
+        keys = scan_cache_keys(file_unique_id=media.file_unique_id, image_bytes=image_bytes)
+        cached = await get_scan_result(keys[1:])
+        if cached:
+            INTERACTIVE.end(uid)
+            await put_scan_result(keys, cached["results"], cached["source"])
+            await inc_stat_db("qrscan")
+            return await prompt.edit_text(f"✅ *Decode Success ({cached['source']}, cached):*\n\n`{chr(10).join(cached['results'])}`")
+
+        await prompt.edit_text("🔎 Scanning locally (using zbar)...")
+        async with op_slot("qrscan", prompt.edit_text) as ok:
+            if not ok:
+                INTERACTIVE.end(uid)
+                return await prompt.edit_text(ADMISSION_BUSY_TEXT)
+            try:
+                local_res, stage = await DECODE_QUEUE.submit(
+                    local_scan_qr, image_bytes,
+                    on_queue=lambda pos: prompt.edit_text(f"⏳ Scanner is busy: you're #{pos} in the queue..."))
+            except CpuQueueFull:
+                INTERACTIVE.end(uid)
+                return await prompt.edit_text(ADMISSION_BUSY_TEXT)
+        record_scan_stage(stage)
+        if local_res:
+            SCAN_DOWNLOAD_STATS["decoded_at"][label if label == "full" else "reduced"] += 1
+            break
+    await inc_stat_db("qrscan")
     
     if local_res:
-        INTERACTIVE.pop(uid, None)
+        INTERACTIVE.end(uid)
+        await put_scan_result(keys, local_res, "local")
         await prompt.edit_text(f"✅ *Local Decode Success:*\n\n`{chr(10).join(local_res)}`")
-        asyncio.create_task(schedule_delete(fpath,delay=300)); 
         return
     
-    # Fallback offer (as requested)
-    INTERACTIVE[uid] = {"flow": "qrscan_fallback", "pending_file": fpath}
+    # Fallback offer (as requested). Bytes stay in memory and are posted straight to the API.
+    INTERACTIVE.start(uid, "qrscan_fallback", pending_bytes=image_bytes, scan_keys=keys)
     kb = InlineKeyboardMarkup([
         [InlineKeyboardButton("✅ Yes, Use Partner API", callback_data="qrfb|yes")],
         [InlineKeyboardButton("❌ No, Cancel", callback_data="qrfb|no")]
@@ -842,45 +2837,45 @@ async def qrfallback_cb(_, cq):
     await cq.answer()
     uid = cq.from_user.id; action = cq.data.split("|",1)[1]
     
-    st = INTERACTIVE.get(uid)
-    if not st or st.get("flow") != "qrscan_fallback" or "pending_file" not in st: 
+    st = INTERACTIVE.get(uid, "qrscan_fallback")
+    if not st or st.pending_bytes is None: 
         return await cq.message.edit_text("Session expired.")
     
-    fpath = st["pending_file"]
-    
     if action == "no":
-        INTERACTIVE.pop(uid, None)
-        try: os.remove(fpath)
-        except Exception: pass
+        INTERACTIVE.end(uid)
         return await cq.message.edit_text("Scan cancelled.")
     
     await cq.message.edit_text("🔁 Scanning with external API (api.qrserver.com)...")
-    loop = asyncio.get_event_loop()
-    res = await loop.run_in_executor(None, partial(fallback_scan_qr_api, fpath))
-    INTERACTIVE.pop(uid, None)
+    keys = st.scan_keys or []
+    async with op_slot("qrscan", cq.message.edit_text) as ok:
+        res = await fallback_scan_qr_api(st.pending_bytes) if ok else None
+    INTERACTIVE.end(uid)
+    if not ok:
+        return await cq.message.edit_text(ADMISSION_BUSY_TEXT)
     
     if res: 
+        await put_scan_result(keys, res, "external")
         await cq.message.edit_text(f"✅ *External Decode Success:*\n\n`{chr(10).join(res)}`")
     else: 
         await cq.message.edit_text("❌ External decode also failed. Could not read QR code.")
-        
-    asyncio.create_task(schedule_delete(fpath,delay=300))
 
 
 # ---------- /shortner (URL Shortener) ----------
 @app.on_message(filters.command("shortner")) # Using "shortner" as requested
 async def shorten_start(_, msg: Message):
-    if not get_features_db().get("shorten", True):
+    if not (await get_features_db()).get("shorten", True):
         return await msg.reply_text("⚠️ This feature is temporarily disabled by the admin.")
     
-    register_user_db(msg.from_user.id)
+    await register_user_db(msg.from_user.id)
     uid = msg.from_user.id
-    INTERACTIVE[uid] = {"flow":"shorten","state":"wait_url"}
+    if not await admit(uid, "shorten", msg.reply_text):
+        return
+    INTERACTIVE.start(uid, "shorten", step="wait_url")
     await msg.reply_text("🔗 Send me the long URL you want to shorten (must start with `http://` or `https://`):")
 
 
-async def handle_shorten_step(msg: Message, state: Dict):
-    uid = msg.from_user.id; st = state.get("state")
+async def handle_shorten_step(msg: Message, state: Session):
+    uid = msg.from_user.id; st = state.step
     try:
         if st == "wait_url":
             text = (msg.text or "").strip()
@@ -888,8 +2883,8 @@ async def handle_shorten_step(msg: Message, state: Dict):
                 await msg.reply_text("Invalid URL. Please send a valid URL (must start with `http://` or `https://`).")
                 return
             
-            state["long_url"] = text
-            state["state"] = "wait_alias"
+            state.long_url = text
+            state.step = "wait_alias"
             kb = InlineKeyboardMarkup([
                 [InlineKeyboardButton("Skip (Use Random Alias)", callback_data="alias|skip")],
                 [InlineKeyboardButton("Enter Alias Manually", callback_data="alias|manual")]
@@ -903,23 +2898,26 @@ async def handle_shorten_step(msg: Message, state: Dict):
                 await msg.reply_text("Alias cannot be empty. Please send a valid alias (e.g., `my-link`) or /cancel.")
                 return
             
-            await msg.reply_text("⏳ Shortening with custom alias...")
-            loop = asyncio.get_event_loop()
-            res = await loop.run_in_executor(None, partial(quicklink_shorten, state["long_url"], alias_text))
+            notice = await msg.reply_text("⏳ Shortening with custom alias...")
+            async with op_slot("shorten", notice.edit_text) as ok:
+                if not ok:
+                    INTERACTIVE.end(uid)
+                    return await notice.edit_text(ADMISSION_BUSY_TEXT)
+                res = await shorten_url(state.long_url, alias_text)
             
             short_url = res.get("shortenedUrl") or res.get("shortUrl") or ""
             if res.get("status") == "success" and short_url:
-                inc_stat_db("shorten"); push_short_url_db(short_url)
-                await msg.reply_text(f"✅ *Shortened Successfully!*\n\n🔗 *Short URL:* {short_url}\n📄 *Original:* {state['long_url']}")
+                await inc_stat_db("shorten"); await push_short_url_db(short_url)
+                await msg.reply_text(f"✅ *Shortened Successfully!*\n\n🔗 *Short URL:* {short_url}\n📄 *Original:* {state.long_url}")
             else: 
                 await msg.reply_text(f"❌ *Error:*\n{res.get('message','Unknown error occurred.')}")
             
-            INTERACTIVE.pop(uid, None)
+            INTERACTIVE.end(uid)
             
     except Exception as e:
         print(f"Error in handle_shorten_step (uid {uid}): {e}")
         await msg.reply_text("An error occurred. Flow cancelled.")
-        INTERACTIVE.pop(uid, None)
+        INTERACTIVE.end(uid)
 
 
 @app.on_callback_query(filters.regex(r"^alias\|"))
@@ -927,33 +2925,238 @@ async def alias_cb(_, cq):
     await cq.answer()
     uid = cq.from_user.id; action = cq.data.split("|",1)[1]
     
-    state = INTERACTIVE.get(uid)
-    if not state or state.get("flow")!="shorten": 
+    state = INTERACTIVE.get(uid, "shorten")
+    if not state: 
         return await cq.message.edit_text("Session expired.")
     
     if action == "skip":
         await cq.message.edit_text("⏳ Shortening with random alias...")
-        loop = asyncio.get_event_loop()
-        res = await loop.run_in_executor(None, partial(quicklink_shorten, state["long_url"], "")) # Empty alias for random
+        async with op_slot("shorten", cq.message.edit_text) as ok:
+            if not ok:
+                INTERACTIVE.end(uid)
+                return await cq.message.edit_text(ADMISSION_BUSY_TEXT)
+            res = await shorten_url(state.long_url, "") # Empty alias for random (reuses an existing short link)
         
         short_url = res.get("shortenedUrl") or res.get("shortUrl") or ""
         if res.get("status")=="success" and short_url: 
-            inc_stat_db("shorten"); push_short_url_db(short_url)
-            await cq.message.edit_text(f"✅ *Shortened Successfully!*\n\n🔗 *Short URL:* {short_url}\n📄 *Original:* {state['long_url']}")
+            await inc_stat_db("shorten"); await push_short_url_db(short_url)
+            await cq.message.edit_text(f"✅ *Shortened Successfully!*\n\n🔗 *Short URL:* {short_url}\n📄 *Original:* {state.long_url}")
         else: 
             await cq.message.edit_text(f"❌ *Error:*\n{res.get('message','Unknown error occurred.')}")
             
-        INTERACTIVE.pop(uid, None)
+        INTERACTIVE.end(uid)
 
     elif action == "manual":
-        state["state"] = "wait_alias_manual"
+        state.step = "wait_alias_manual"
         await cq.message.edit_text("OK, please send the custom alias you want to use (e.g., `my-link`).")
 
 
+# ---------- /bulkshort (many URLs at once) ----------
+BULK_MAX_URLS = int(os.getenv("BULK_MAX_URLS", "500"))
+BULK_CONCURRENCY = int(os.getenv("BULK_CONCURRENCY", "5"))
+BULK_MAX_FILE_BYTES = 1024 * 1024
+BULK_PROGRESS_INTERVAL = 2.0  # seconds between progress edits
+URL_RE = re.compile(r"https?://[^\s<>\"',;]+")
+
+
+def extract_urls(text: str) -> List[str]:
+    seen = {}
+    for m in URL_RE.finditer(text or ""):
+        seen.setdefault(m.group(0).rstrip(").]}!?."), None)  # dict keeps first-seen order
+    return list(seen)
+
+
+async def bulk_source_text(msg: Message) -> str:
+    if msg.document:
+        name = (msg.document.file_name or "").lower()
+        if not name.endswith((".txt", ".csv")) or (msg.document.file_size or 0) > BULK_MAX_FILE_BYTES:
+            return ""
+        return (await msg.download(in_memory=True)).getvalue().decode("utf-8", errors="ignore")
+    return msg.text or msg.caption or ""
+
+
+@app.on_message(filters.command("bulkshort"))
+async def bulkshort_cmd(_, msg: Message):
+    if not (await get_features_db()).get("shorten", True):
+        return await msg.reply_text("⚠️ This feature is temporarily disabled by the admin.")
+    
+    await register_user_db(msg.from_user.id)
+    if not await admit(msg.from_user.id, "bulkshort", msg.reply_text):
+        return
+    # URLs can come with the command (text, or a .txt/.csv captioned /bulkshort), from a
+    # replied-to message/file, or as the next message
+    urls = extract_urls(await bulk_source_text(msg))
+    if not urls and msg.reply_to_message:
+        urls = extract_urls(await bulk_source_text(msg.reply_to_message))
+    if not urls:
+        prompt = await msg.reply_text("📋 Send the URLs (one message, any format) or a .txt/.csv file within 2 minutes.")
+        try:
+            got = await app.listen(chat_id=msg.chat.id, timeout=120, filters=filters.text | filters.document)
+        except asyncio.TimeoutError:
+            return await prompt.edit_text("⏰ Timeout — nothing received. Bulk shortening cancelled.")
+        urls = extract_urls(await bulk_source_text(got))
+    if not urls:
+        return await msg.reply_text("No `http://` or `https://` URLs found. Bulk shortening cancelled.")
+    
+    skipped = max(0, len(urls) - BULK_MAX_URLS)
+    urls = urls[:BULK_MAX_URLS]
+    progress = await msg.reply_text(f"⏳ Shortening {len(urls)} URLs... 0/{len(urls)}")
+    results: Dict[str, Dict[str, Any]] = {}
+    sem = asyncio.Semaphore(BULK_CONCURRENCY)
+    last_edit = time.monotonic()
+
+    async def worker(url: str):
+        nonlocal last_edit
+        async with sem:
+            results[url] = await shorten_url(url)
+        if time.monotonic() - last_edit >= BULK_PROGRESS_INTERVAL:
+            last_edit = time.monotonic()
+            try:
+                await progress.edit_text(f"⏳ Shortening {len(urls)} URLs... {len(results)}/{len(urls)}")
+            except Exception:
+                pass  # progress edits are best-effort (FloodWait, "not modified")
+
+    # The whole job holds one bulkshort slot; BULK_CONCURRENCY bounds it internally
+    async with op_slot("bulkshort", progress.edit_text) as ok:
+        if not ok:
+            return await progress.edit_text(ADMISSION_BUSY_TEXT)
+        await asyncio.gather(*(worker(u) for u in urls))
+
+    rows, ok_urls = [], []
+    for url in urls:
+        res = results[url]
+        short_url = res.get("shortenedUrl") or res.get("shortUrl") or ""
+        if res.get("status") == "success" and short_url:
+            ok_urls.append(short_url)
+            rows.append((url, short_url, "ok"))
+        else:
+            rows.append((url, "", res.get("message", "error")))
+    # One batched stats write for the whole job
+    await inc_stat_db("shorten", len(ok_urls))
+    await push_short_urls_db(ok_urls)
+
+    summary = f"✅ *Bulk Shortening Done*\n\nShortened: {len(ok_urls)}/{len(urls)}"
+    if skipped:
+        summary += f"\nSkipped (over {BULK_MAX_URLS} limit): {skipped}"
+    body = "\n".join(f"{short or '❌'} ← {url}" for url, short, _ in rows)
+    if len(summary) + len(body) < 3500:
+        return await progress.edit_text(f"{summary}\n\n{body}", disable_web_page_preview=True)
+    out = io.StringIO()
+    csv.writer(out).writerows([("long_url", "short_url", "status"), *rows])
+    doc = io.BytesIO(out.getvalue().encode("utf-8"))
+    doc.name = "shortened.csv"
+    await progress.edit_text(summary)
+    await msg.reply_document(doc, caption="📄 Full results")
+
+
+# ---------- Inline mode: @bot <url or text> ----------
+# Inline queries fire on every keystroke, so each user's query is debounced (only the
+# last one after INLINE_DEBOUNCE seconds does any work), final results are cached per
+# query for INLINE_CACHE_TIME, and Telegram is told to cache them too (cache_time).
+# Degraded answers (shortening failed, a feature off, nothing to show) are never cached
+# and only get a short Telegram cache_time, so they clear once things recover.
+# Short links go through shorten_url; the QR is served from the QR cache by file_id, or
+# rendered once and fetched by Telegram from our web server (/qr/<key>.jpg) when
+# PUBLIC_URL is known. Every built answer costs the user a "shorten" admission token and
+# runs under the shorten/qrgen slots, like the /shortner and /qrgen flows.
+INLINE_DEBOUNCE = float(os.getenv("INLINE_DEBOUNCE", "0.7"))
+INLINE_CACHE_TIME = int(os.getenv("INLINE_CACHE_TIME", "300"))
+INLINE_CACHE_MAX = int(os.getenv("INLINE_CACHE_MAX", "2000"))
+INLINE_DEGRADED_CACHE_TIME = 5
+INLINE_QR_PROFILE = "inline"
+PUBLIC_URL = (os.getenv("PUBLIC_URL") or os.getenv("RENDER_EXTERNAL_URL") or "").rstrip("/")
+INLINE_CACHE: "OrderedDict[str, Tuple[float, List[Any]]]" = OrderedDict()  # query -> (expires, results)
+# Served by /qr/<key>.jpg: key -> (expires, payload). Telegram may show a result for
+# cache_time after our own cached answer, hence twice INLINE_CACHE_TIME.
+INLINE_QR_PAYLOADS: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+INLINE_SEQ: Dict[int, int] = {}
+INLINE_STATS = {"queries": 0, "superseded": 0, "cache_hits": 0, "built": 0}
+
+
+def _lru_put(cache: OrderedDict, key: str, value: Any, limit: int):
+    cache[key] = value
+    cache.move_to_end(key)
+    while len(cache) > limit:
+        cache.popitem(last=False)
+
+
+async def build_inline_results(query: str) -> Tuple[List[Any], bool]:
+    # Returns (results, cacheable)
+    features = await get_features_db()
+    results = []
+    qr_payload = query
+    cacheable = features.get("shorten", True) and features.get("qrgen", True)
+    is_url = query.startswith(("http://", "https://")) and " " not in query
+    if is_url and features.get("shorten", True):
+        async with op_slot("shorten") as ok:
+            res = await shorten_url(query) if ok else {}
+        short_url = res.get("shortenedUrl") or res.get("shortUrl") or ""
+        if not (res.get("status") == "success" and short_url):
+            cacheable = False  # shed / open circuit / upstream error: retry on the next query
+        else:
+            qr_payload = short_url  # smaller, easier-to-scan QR
+            results.append(InlineQueryResultArticle(
+                title="🔗 Short link", description=short_url, id=f"s{hashlib.md5(query.encode()).hexdigest()}",
+                input_message_content=InputTextMessageContent(f"🔗 {short_url}\n📄 {query}", disable_web_page_preview=True)
+            ))
+    if features.get("qrgen", True):
+        # Already sent through /qrgen as a link: reuse that photo's file_id (an SVG profile
+        # goes out as a document, which a cached photo result can't carry)
+        link_profile = get_qr_profile(QR_TYPE_PROFILES["link"])
+        entry = QR_CACHE.get(qr_cache_key(qr_payload, link_profile)) if link_profile["format"] != "svg" else None
+        key = qr_cache_key(qr_payload, get_qr_profile(INLINE_QR_PROFILE))
+        caption = f"QR: {qr_payload[:200]}"
+        if entry and entry.get("file_id"):
+            results.append(InlineQueryResultCachedPhoto(photo_file_id=entry["file_id"], id=f"q{key[:32]}", caption=caption))
+        elif PUBLIC_URL:
+            _lru_put(INLINE_QR_PAYLOADS, key, (time.monotonic() + 2 * INLINE_CACHE_TIME, qr_payload), INLINE_CACHE_MAX)
+            url = f"{PUBLIC_URL}/qr/{key}.jpg"
+            results.append(InlineQueryResultPhoto(photo_url=url, thumb_url=url, id=f"q{key[:32]}", title="🔳 QR code", caption=caption))
+    return results, cacheable and bool(results)
+
+
+@app.on_inline_query()
+async def inline_query_handler(_, iq: InlineQuery):
+    query = (iq.query or "").strip()
+    if not query:
+        return await iq.answer([], cache_time=INLINE_CACHE_TIME, switch_pm_text="Type a URL or text to shorten / get a QR", switch_pm_parameter="inline")
+    INLINE_STATS["queries"] += 1
+    cached = INLINE_CACHE.get(query)
+    if cached is not None:
+        if cached[0] > time.monotonic():
+            INLINE_CACHE.move_to_end(query)
+            INLINE_STATS["cache_hits"] += 1
+            return await iq.answer(cached[1], cache_time=INLINE_CACHE_TIME)
+        del INLINE_CACHE[query]
+
+    uid = iq.from_user.id
+    seq = INLINE_SEQ.get(uid, 0) + 1
+    INLINE_SEQ[uid] = seq
+    await asyncio.sleep(INLINE_DEBOUNCE)
+    if INLINE_SEQ.get(uid) != seq:
+        INLINE_STATS["superseded"] += 1  # user kept typing; the newer query does the work
+        return
+    INLINE_SEQ.pop(uid, None)
+
+    async def slow_down(text: str):
+        await iq.answer([], cache_time=INLINE_DEGRADED_CACHE_TIME, switch_pm_text=text, switch_pm_parameter="inline")
+
+    if not await admit(uid, "shorten", slow_down):
+        return
+    INLINE_STATS["built"] += 1
+    results, cacheable = await build_inline_results(query)
+    if cacheable:
+        _lru_put(INLINE_CACHE, query, (time.monotonic() + INLINE_CACHE_TIME, results), INLINE_CACHE_MAX)
+    try:
+        await iq.answer(results, cache_time=INLINE_CACHE_TIME if cacheable else INLINE_DEGRADED_CACHE_TIME)
+    except Exception as e:
+        print(f"Error answering inline query: {e}")
+
+
 # ---------- /owner (Owner Info) ----------
 @app.on_message(filters.command("owner"))
 async def owner_cmd(_, msg: Message):
-    register_user_db(msg.from_user.id)
+    await register_user_db(msg.from_user.id)
     # Matches your feature list
     kb = InlineKeyboardMarkup(
         [
@@ -978,7 +3181,9 @@ async def web_index(request):
     start_time_ist = datetime.fromtimestamp(START_TS) + timedelta(hours=5, minutes=30)
 
     up = uptime_str()
-    stats = get_stats_db()
+    stats = await get_stats_db()
+    state_icons = {"closed": "🟢", "half_open": "🟡", "open": "🔴"}
+    upstream_html = " | ".join(f"{state_icons[u.state]} {name}" for name, u in UPSTREAMS.items())
     
     html = f"""
     <html>
@@ -1002,6 +3207,7 @@ async def web_index(request):
         <p><span class="status">✅ Quicklink Bot is Live</span></p>
         <p><b>Bot Uptime:</b> {up}</p>
         <p><b>Stats:</b> {stats.get('shorten',0)} Shortens | {stats.get('qrgen',0)} QR Gens | {stats.get('qrscan',0)} QR Scans</p>
+        <p><b>Upstreams:</b> {upstream_html}</p>
         <p><b>Bot Started:</b> {start_time_ist.strftime('%Y-%m-%d %I:%M:%S %p')} IST</p>
         <p><b>Uptime Ping:</b> 📡 UptimeRobot Ping Enabled</p>
         
@@ -1016,9 +3222,49 @@ async def web_index(request):
     return web.Response(text=html, content_type="text/html")
 
 
+def collect_metrics() -> Dict[str, Any]:
+    return {
+        "uptime_s": int(time.time() - START_TS),
+        "worker": {"index": WORKER_INDEX, "count": WORKER_COUNT, "id": WORKER_ID, "leader": IS_LEADER,
+                   "broadcasts_running": list(BROADCAST_RUNNING)},
+        "known_users": known_users_metrics(),
+        "stats_buffer": dict(STAT_BUFFER),
+        "long_urls": {"size": len(LONG_URL_CACHE), "max": LONG_URL_CACHE_MAX, "inflight": len(LONG_URL_INFLIGHT), **LONG_URL_STATS},
+        "inline": {"cache_size": len(INLINE_CACHE), **INLINE_STATS},
+        "chat_cache": {"size": len(CHAT_CACHE), "max": CHAT_CACHE_MAX, **CHAT_CACHE_STATS},
+        "upstreams": {name: u.health() for name, u in UPSTREAMS.items()},
+        "sessions": INTERACTIVE.metrics(),
+        "admission": admission_metrics(),
+        "cpu_queues": {"qr": QR_QUEUE.metrics(), "decode": DECODE_QUEUE.metrics()},
+        "scan_stages": dict(SCAN_STAGE_STATS),
+        "scan_downloads": scan_download_metrics(),
+        "scan_cache": {"size": len(SCAN_CACHE), "max": SCAN_CACHE_MAX, **SCAN_CACHE_STATS},
+        "qr_cache": {"size": len(QR_CACHE), "max": QR_CACHE_MAX, "inflight": len(QR_INFLIGHT), **QR_CACHE_STATS},
+    }
+
+
+async def web_qr(request):
+    # Only payloads registered by an admitted inline query, and not yet expired, are rendered
+    entry = INLINE_QR_PAYLOADS.get(request.match_info["key"])
+    if entry is None or entry[0] <= time.monotonic():
+        raise web.HTTPNotFound()
+    async with op_slot("qrgen") as ok:
+        if not ok:
+            raise web.HTTPTooManyRequests(headers={"Retry-After": "5"})
+        try:
+            jpg = await get_qr_bytes(entry[1], INLINE_QR_PROFILE)
+        except CpuQueueFull:
+            raise web.HTTPServiceUnavailable(headers={"Retry-After": "5"})
+    return web.Response(body=jpg, content_type="image/jpeg", headers={"Cache-Control": "public, max-age=86400"})
+
+
+async def web_metrics(request):
+    return web.json_response(collect_metrics())
+
+
 async def run_web():
     app_web = web.Application()
-    app_web.add_routes([web.get('/', web_index)])
+    app_web.add_routes([web.get('/', web_index), web.get('/metrics', web_metrics), web.get('/qr/{key}.jpg', web_qr)])
     runner = web.AppRunner(app_web)
     await runner.setup()
     # Binds to 0.0.0.0 and the PORT from env var
@@ -1035,32 +3281,39 @@ async def run_web():
 # -------------------------
 async def main():
     # try ensure storage sync initial
-    if mongo_ok:
-        try:
-            # Ensure all features from the keyboard are in the config
-            DB["config"].update_one(
-                {"_id":"features"}, 
-                {"$setOnInsert":{
-                    "shorten":True, "qrgen":True, "qrscan":True, "broadcast":True, "chat":True
-                }}, 
-                upsert=True
-            )
-        except Exception:
-            pass
-    else:
-        save_storage_local(LOCAL)
+    await init_storage_db()
+    await warm_known_users()
+    # Fork the QR workers early, before Pyrogram starts its own threads
+    await render_qr("warmup", {**QR_PROFILES["mono"], "size": 100}, priority=PRIORITY_BULK)
+    # SIGTERM (Render deploys, the worker launcher) ends the wait below instead of killing
+    # the process, so the finally still flushes buffered stats. Registered after the QR
+    # pool fork so the children do not inherit the loop's wakeup fd.
+    stop = asyncio.Event()
+    try:
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stop.set)
+    except NotImplementedError:
+        pass  # no loop signal handlers on Windows
 
     print("Starting web server and Pyrogram bot...")
     
     try:
-        # We start the web server first, as it's needed for Render to not time out
-        await run_web()
+        # We start the web server first, as it's needed for Render to not time out.
+        # Only worker 0 binds PORT; the others share its host.
+        if WORKER_INDEX == 0:
+            await run_web()
+        spawn_bg(stat_flush_loop())
+        spawn_bg(session_sweep_loop())
+        start_feature_watch()
         print("Web server is running. Now starting Pyrogram bot...")
         await app.start()
-        print(f"Bot started successfully! Uptime: {uptime_str()}")
+        print(f"Bot started successfully! Worker {WORKER_INDEX + 1}/{WORKER_COUNT}. Uptime: {uptime_str()}")
+        spawn_bg(leader_loop())
+        if WORKER_COUNT > 1:
+            spawn_bg(dead_sync_loop())
         
-        # Keep the script running
-        await asyncio.Event().wait()
+        # Keep the script running until SIGTERM
+        await stop.wait()
+        print("SIGTERM received, shutting down...")
         
     except Exception as e:
         print(f"CRITICAL ERROR in main: {e}")
@@ -1068,10 +3321,64 @@ async def main():
         # Ensure bot stops if main loop exits
         if app.is_connected:
             await app.stop()
+        await flush_stats_db()
+        await close_http()
+        if QR_POOL is not None:
+            QR_POOL.shutdown(wait=False, cancel_futures=True)
+        DECODE_POOL.shutdown(wait=False, cancel_futures=True)
         print("Bot stopped.")
 
 
+WORKER_RESTART_MAX_BACKOFF = 60  # seconds
+
+
+def run_workers():
+    # Local launcher: one child process per worker, each with its own WORKER_INDEX.
+    # A worker that dies is restarted with the same index (exponential backoff, reset
+    # after a minute of healthy uptime), otherwise its share of users would go silent.
+    def spawn(i: int) -> subprocess.Popen:
+        p = subprocess.Popen([sys.executable, os.path.abspath(__file__)], env={**os.environ, "WORKER_INDEX": str(i)})
+        print(f"Started worker {i} (pid {p.pid})")
+        return p
+
+    # SIGTERM (platform shutdown) unwinds through the finally below and stops the children
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    procs = {i: spawn(i) for i in range(WORKER_COUNT)}
+    started = {i: time.monotonic() for i in procs}
+    backoff = {i: 1.0 for i in procs}
+    restart_at: Dict[int, float] = {}
+    try:
+        while True:
+            now = time.monotonic()
+            for i, p in procs.items():
+                if i in restart_at or p.poll() is None:
+                    continue
+                if now - started[i] > WORKER_RESTART_MAX_BACKOFF:
+                    backoff[i] = 1.0
+                print(f"Worker {i} (pid {p.pid}) exited with code {p.returncode}; restarting in {backoff[i]:.0f}s")
+                restart_at[i] = now + backoff[i]
+                backoff[i] = min(backoff[i] * 2, WORKER_RESTART_MAX_BACKOFF)
+            for i, at in list(restart_at.items()):
+                if now >= at:
+                    del restart_at[i]
+                    procs[i] = spawn(i)
+                    started[i] = now
+            time.sleep(1)
+    finally:
+        for p in procs.values():
+            if p.poll() is None:
+                p.terminate()
+        for p in procs.values():
+            p.wait()
+
+
 if __name__ == "__main__":
+    if IS_LAUNCHER:
+        try:
+            run_workers()
+        except KeyboardInterrupt:
+            print("Workers stopped manually.")
+        raise SystemExit(0)
     try:
         asyncio.run(main())
     except KeyboardInterrupt: